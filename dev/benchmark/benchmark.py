@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    benchmark.py
+# @brief   Measure time and peak memory use of Split It! operations
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/caltechlibrary/splitit
+# =============================================================================
+#
+# This generates a synthetic input file by repeating the rows of the sample
+# file in tests/data (with new record ids and barcodes), then runs each
+# scenario in a separate process and reports the wall-clock time and the
+# peak resident set size (RSS) of that process.  It relies on the Python
+# "resource" module, and therefore does not work on Windows.
+#
+# Example:
+#
+#   python3 dev/benchmark/benchmark.py -r 1000000
+
+import csv
+import os
+from   os import path
+import plac
+import resource
+import subprocess
+import sys
+import tempfile
+from   time import time
+
+here = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.join(here, '..', '..'))
+
+from splitit.merge import Merger
+from splitit.pipeline import Pipeline, read_rows
+from splitit.records import RecordStore
+from splitit.rows import split_row, split_rows
+
+_SAMPLE = path.join(here, '..', '..', 'tests', 'data', 'sample.csv')
+
+_SCENARIOS = {
+    'hold-lists'   : 'hold split rows in memory as lists of strings',
+    'hold-records' : 'hold split rows in memory in a RecordStore',
+    'split'        : 'split a file, sequentially',
+    'split-piped'  : 'split a file, with reader and writer threads',
+    'sort'         : 'split a file and sort it by call number',
+    'merge'        : 'merge a file with a copy of itself, removing duplicates',
+}
+
+
+def run_scenario(name, input_file, output_file):
+    if name == 'hold-lists':
+        held = split_rows(read_rows(input_file))
+    elif name == 'hold-records':
+        held = RecordStore()
+        for row in read_rows(input_file):
+            held.extend(split_row(row))
+    elif name == 'split':
+        Pipeline(input_file, output_file).run()
+    elif name == 'split-piped':
+        Pipeline(input_file, output_file, threaded = True).run()
+    elif name == 'sort':
+        Pipeline(input_file, output_file, sort = 'callnumber',
+                 max_memory = 1024**4).run()
+    elif name == 'merge':
+        # Both inputs are out of order, so both are sorted in memory.
+        Merger([input_file, input_file], output_file, max_memory = 1024**4).run()
+
+
+def make_input(filename, num_rows):
+    with open(_SAMPLE, newline = '', encoding = 'utf8') as f:
+        sample = list(csv.reader(f))
+    header, rows = sample[0], sample[1:]
+    with open(filename, 'w', newline = '', encoding = 'utf8') as f:
+        writer = csv.writer(f, lineterminator = '\n')
+        writer.writerow(header)
+        for n in range(num_rows):
+            row = list(rows[n % len(rows)])
+            copy = n // len(rows)
+            row[0] = _renumbered(row[0], copy * 1000000)
+            row[1] = '; '.join(_renumbered(b.strip(), copy) for b in row[1].split(';'))
+            writer.writerow(row)
+
+
+def _renumbered(value, offset):
+    if value.isdigit():
+        return str(int(value) + offset)
+    return '{}-{}'.format(value, offset)
+
+
+@plac.annotations(
+    rows     = ('number of input rows to generate (default: 500000)', 'option', 'r', int),
+    scenario = ('(internal) run one scenario and report its results',  'option', 's'),
+    input    = ('(internal) input file for the scenario',              'option', 'i'),
+)
+
+def main(rows = 500000, scenario = None, input = None):
+    if scenario:
+        output_file = input + '.out'
+        start = time()
+        run_scenario(scenario, input, output_file)
+        elapsed = time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # On macOS, ru_maxrss is in bytes; on Linux, it's in kilobytes.
+        if sys.platform != 'darwin':
+            peak *= 1024
+        if path.exists(output_file):
+            os.remove(output_file)
+        print('{} {}'.format(elapsed, peak))
+        return
+
+    with tempfile.TemporaryDirectory(prefix = 'splitit-bench-') as tmp:
+        input_file = path.join(tmp, 'input.csv')
+        print('Generating {} rows ...'.format(rows))
+        make_input(input_file, rows)
+        print('{:<14} {:>10} {:>14}   {}'.format('scenario', 'time (s)', 'peak RSS (MB)', ''))
+        for name, description in _SCENARIOS.items():
+            result = subprocess.run([sys.executable, __file__, '-s', name, '-i', input_file],
+                                    stdout = subprocess.PIPE, check = True)
+            elapsed, peak = result.stdout.decode().split()
+            print('{:<14} {:>10.2f} {:>14.1f}   {}'.format(
+                name, float(elapsed), int(peak) / 1024**2, description))
+
+
+if __name__ == '__main__':
+    plac.call(main)
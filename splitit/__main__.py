@@ -13,7 +13,6 @@ open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
-import csv
 import os
 from   os import path
 import plac
@@ -23,9 +22,16 @@ from   sys import exit as exit
 import splitit
 from splitit.debug import set_debug, log
 from splitit.exceptions import *
-from splitit.files import readable, writable, file_in_use, is_csv
-from splitit.files import file_to_open, file_to_save
+from splitit.files import readable, writable, file_in_use, is_csv, is_xlsx
+from splitit.gui import file_to_open, file_to_save, run_with_progress
+from splitit.join import Joiner, JOIN_KEYS, unmatched_file
+from splitit.manifest import manifest_file, write_manifest
+from splitit.merge import Merger
 from splitit.messages import MessageHandlerCLI
+from splitit.output import SHARD_CHOICES, DEFAULT_SHARD_COUNT
+from splitit.pipeline import Pipeline, file_sha256, DEFAULT_BUFFER_SIZE
+from splitit.sorting import DEFAULT_MAX_MEMORY
+from splitit.summary import Summary, summary_file
 
 
 # Main program.
@@ -35,30 +41,70 @@ from splitit.messages import MessageHandlerCLI
     no_gui     = ('do not use GUI dialogs to ask for files (default: do)', 'flag',   'G'),
     input_csv  = ('input file to be reformatted',                          'option', 'i'),
     output_csv = ('output file where results should be written',           'option', 'o'),
+    pipelined  = ('overlap reading, splitting & writing using threads',   'flag',   'p'),
+    buffer_kb  = ('size of file I/O buffers, in KB (default: 1024)',       'option', 'b', int),
+    sort       = ('sort the output rows (choices: callnumber)',            'option', 's',
+                  str, ['callnumber'], 'ORDER'),
+    max_memory = ('memory for sorting & joins, in MB (default: 256)',      'option', 'm', int),
+    shard_by   = ('divide output into files by: class, status or hash',    'option', 'd',
+                  str, SHARD_CHOICES, 'TYPE'),
+    shards     = ('number of files when dividing by hash (default: 8)',    'option', 'n', int),
+    join       = ('add the columns of a lookup table to the output rows',  'option', 'j',
+                  str, None, 'FILE'),
+    join_on    = ('match lookup rows by: barcode (default) or record',     'option', 'k',
+                  str, JOIN_KEYS, 'KEY'),
+    summarize  = ('write a summary of counts next to the output file',     'flag',   'S'),
+    manifest   = ('write checksums & run details to a manifest file',      'flag',   'M'),
     no_color   = ('do not color-code terminal output',                     'flag',   'C'),
     quiet      = ('only print important messages while working',           'flag',   'q'),
     version    = ('print version info and exit',                           'flag',   'V'),
     debug      = ('turn on debug tracing & exception catching',            'flag',   '@'),
+    command    = ('"merge" followed by the files to be merged',            'positional'),
 )
 
-def main(no_gui = False, input_csv = 'I', output_csv = 'O', no_color = False,
-         quiet = False, version = False, debug = False):
+def main(no_gui = False, input_csv = 'I', output_csv = 'O', pipelined = False,
+         buffer_kb = DEFAULT_BUFFER_SIZE // 1024, sort = None,
+         max_memory = DEFAULT_MAX_MEMORY // (1024 * 1024), shard_by = None,
+         shards = DEFAULT_SHARD_COUNT, join = None, join_on = 'barcode',
+         summarize = False, manifest = False, no_color = False, quiet = False,
+         version = False, debug = False, *command):
     '''Split It!
 
 If the options -i and/or -o (or /i and /o on Windows) are not supplied, this
 program will use GUI file dialogs to ask the user for the input and/or output
-files (respectively) unless the option -G (/G on Windows) is used.
+files (respectively) unless the option -G (/G on Windows) is used.  When
+the GUI dialogs are used, this program also shows a progress window while it
+works; clicking its Cancel button stops the work and removes the incomplete
+output.
 
 If the -G option (/G on Windows) is supplied to prevent the use of the GUI,
 then this program must be invoked with two command-line options and values:
 -i and -o (or /i and /o on Windows).  The -i option (/i on Windows) should be
-followed by the path to an input file in CSV format that contains the content
-to be reformatted; the -o option (/o on Windows) should be followed by the
-path to a new, reformatted CSV file that should be written with the output.
+followed by the path to an input file in CSV format (or an Excel .xlsx file)
+that contains the content to be reformatted; the -o option (/o on Windows)
+should be followed by the path to a new, reformatted CSV file that should be
+written with the output.
 Here is an example:
 
   splitit -i downloaded.csv -o inventory.csv
 
+Merging several files
+~~~~~~~~~~~~~~~~~~~~~
+
+If the word "merge" is given after the options, followed by the names of two
+or more files, this program will split the rows of every file and merge them
+into the single output file given by -o (/o on Windows).  Rows that appear in
+more than one file are written only once.  If the same record id and barcode
+appear with different values (for example, a different item status), the
+first version is kept and all the versions are listed in a file with a name
+like "inventory-conflicts.csv".  The merged output is ordered by record id
+and barcode.  Here is an example:
+
+  splitit -o inventory.csv merge part1.csv part2.csv part3.csv
+
+The options -b, -m and -M (/b, /m and /M on Windows) can be used when
+merging; the options -i, -p, -s, -d, -n, -S and -j cannot.
+
 Additional command-line arguments
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -69,6 +115,65 @@ option -C (/C on Windows), this program will not color the text of messages
 it prints.  (This latter option is useful when running the program within
 subshells inside other environments such as Emacs.)
 
+If given the -p option (/p on Windows), this program will read the input and
+write the output in separate background threads, so that the work of
+splitting rows overlaps with file input and output.  This can make a large
+difference when the files are located on network storage.  The size of the
+buffers used for reading and writing files can be set using the option -b
+(/b on Windows) followed by a number of kilobytes; the default is 1024.
+
+If given the option -s (/s on Windows) followed by the word "callnumber",
+this program will write the output rows sorted in shelf order, using the
+Library of Congress call numbers in column 5.  If the data does not fit in
+the amount of memory set aside for sorting, this program will use temporary
+files on disk.  The amount of memory can be set using the option -m (/m on
+Windows) followed by a number of megabytes; the default is 256.
+
+If given the option -d (/d on Windows) followed by one of the words "class",
+"status" or "hash", this program will divide the output among several files
+instead of writing a single file.  With "class", rows are put in files
+according to the Library of Congress class of the call number (e.g., "QA");
+with "status", they are put in files according to the item status; and with
+"hash", they are divided among a fixed number of files, keeping all the
+items of a record in the same file.  The number of files in the last case
+can be set using the option -n (/n on Windows); the default is 8.  The names
+of the files are made by adding the name of each part to the output file
+name (e.g., "inventory-QA.csv"), and an index listing the files and the
+number of rows in each is written to a file with a name like
+"inventory-index.csv".
+
+If given the option -j (/j on Windows) followed by the path to a CSV or
+Excel file, this program will add the columns of that file (a lookup table)
+to the end of every output row.  The rows of the lookup table are matched to
+the output rows by barcode, or by record id if the option -k (/k on Windows)
+is followed by the word "record".  The lookup table must have a header row;
+the key is taken from the column named "barcode" (or "record id"), or else
+from the first column.  Output rows that have no match in the lookup table
+are still written, with the added columns left empty, and are also listed in
+a file with a name like "inventory-unmatched.csv".  A lookup table too large
+for the memory limit set by -m is put in an index file on disk next to it
+(e.g., "items.csv.barcode.splitit-index"), which is reused in later runs as
+long as the lookup table and the key do not change.  This option cannot be
+used with "merge".
+
+If given the option -S (/S on Windows), this program will count the rows as
+it splits them, and write a summary in JSON format to a file named like the
+output file with "-summary.json" at the end (e.g., "inventory-summary.json").
+The summary contains the numbers of rows read and written, the numbers of
+simple and compound records, the number of barcodes per record, the number
+of items per status and per Library of Congress class, and the number of
+records whose barcode and status lists have different lengths.
+
+If given the option -M (/M on Windows), this program will write a manifest
+in JSON format to a file named like the output file with "-manifest.json" at
+the end (e.g., "inventory-manifest.json").  The manifest lists the version of
+this program, the options used, the input file(s) with their SHA-256
+checksums, and the output file(s) with their numbers of rows, sizes and
+SHA-256 checksums.  The checksums of the output files are computed while the
+files are written, so the output does not need to be read again.  When the
+output is divided into several files, or several files are merged, they are
+all listed in the same manifest.
+
 If given the -V option (/V on Windows), this program will print the version
 and other information, and exit without doing anything else.
 
@@ -86,6 +191,7 @@ Command-line arguments summary
     prefix = '/' if sys.platform.startswith('win') else '-'
     hint = '(Hint: use {}h for help.)'.format(prefix)
     use_gui = not no_gui
+    gui_used = False
 
     # Preprocess arguments and handle early exits -----------------------------
 
@@ -95,23 +201,48 @@ Command-line arguments summary
         print_version()
         exit()
 
-    if input_csv == 'I' and use_gui:
-        input_csv = file_to_open(splitit.__title__ + ': open input CSV file',
-                                 wildcard = 'CSV file (*.csv)|*.csv|Any file (*.*)|*.*')
+    if command and command[0] != 'merge':
+        exit(say.error_text('Unrecognized command: {}. {}'.format(command[0], hint)))
+    merge_files = list(command[1:])
+    if command and len(merge_files) < 2:
+        exit(say.error_text('Must supply at least 2 files to merge. {}'.format(hint)))
+    if join and merge_files:
+        exit(say.error_text('Cannot use a lookup table when merging. {}'.format(hint)))
+    if merge_files:
+        # These only apply to splitting a single file.
+        unusable = [prefix + letter for letter, given in
+                    [('i', input_csv != 'I'), ('p', pipelined), ('s', sort),
+                     ('d', shard_by), ('n', shards != DEFAULT_SHARD_COUNT), ('S', summarize)]
+                    if given]
+        if unusable:
+            exit(say.error_text('Cannot use {} when merging. {}'.format(
+                ', '.join(unusable), hint)))
+
+    if merge_files:
+        input_files = merge_files
+    elif input_csv == 'I' and use_gui:
+        input_csv = file_to_open(splitit.__title__ + ': open input CSV or Excel file',
+                                 wildcard = 'CSV file (*.csv)|*.csv|Excel file (*.xlsx)|*.xlsx|Any file (*.*)|*.*')
         if input_csv is None:
             exit('Quitting.')
-    else:
+        gui_used = True
+        input_files = [input_csv]
+    elif input_csv == 'I':
         exit(say.error_text('Must supply input file using -i. {}'.format(hint)))
-    if not readable(input_csv):
-        exit(say.error_text('Cannot read file: {}'.format(input_csv)))
-    elif not is_csv(input_csv):
-        exit(say.error_text('File does not appear to contain CSV: {}'.format(input_csv)))
+    else:
+        input_files = [input_csv]
+    for file in input_files + ([join] if join else []):
+        if not readable(file):
+            exit(say.error_text('Cannot read file: {}'.format(file)))
+        elif not (is_xlsx(file) or is_csv(file)):
+            exit(say.error_text('File does not appear to contain CSV or Excel data: {}'.format(file)))
 
     if output_csv == 'O' and use_gui:
         output_csv = file_to_save(splitit.__title__ + ': save output file')
         if output_csv is None:
             exit('Quitting.')
-    else:
+        gui_used = True
+    elif output_csv == 'O':
         exit(say.error_text('Must supply output file using -o. {}'.format(hint)))
     if path.exists(output_csv):
         if file_in_use(output_csv):
@@ -122,50 +253,100 @@ Command-line arguments summary
         dest_dir = path.dirname(output_csv) or os.getcwd()
         if not writable(dest_dir):
             exit(say.error_text('Cannot write to folder: {}'.format(dest_dir)))
+    if buffer_kb < 1:
+        exit(say.error_text('Buffer size must be at least 1 KB. {}'.format(hint)))
+    if max_memory < 1:
+        exit(say.error_text('Memory for sorting & joins must be at least 1 MB. {}'.format(hint)))
+    if shards < 1:
+        exit(say.error_text('Number of output files must be at least 1. {}'.format(hint)))
 
     # Do the real work --------------------------------------------------------
 
-    # Example of possible input:
-    #
-    # 574524,35047011136967,on shelf,,QA7 .A664 1991,
-    # 501345,350470002009169; 35047010046266,on shelf; on shelf,,QA7 .A67 1983,
-
     try:
         say.info('┏━━━━━━━━━━━━━━━━━┓')
         say.info('┃    Split It!    ┃')
         say.info('┗━━━━━━━━━━━━━━━━━┛')
 
-        # Read it, massage it, write it.
-        say.info('Reading input from "{}"'.format(input_csv))
-        input_rows = []
-        with open(input_csv, newline = '', encoding = 'utf8') as csvfile:
-            input_rows = list(csv.reader(csvfile))
-
-        # Simple-minded approach to splitting compound results
-        output_rows = []
-        for row in input_rows:
-            if not row or row[0] == '':
-                continue
-            if ';' in row[1]:
-                new_rows = []
-                for index, part in enumerate(row[1].split(';')):
-                    new_rows.append([row[0], part.strip()])
-                for index, part in enumerate(row[2].split(';')):
-                    new_rows[index].append(part.strip())
-                for index in range(0, len(new_rows)):
-                    new_rows[index].append(row[3].strip())
-                    new_rows[index].append(row[4].strip())
-                    new_rows[index].append(row[5].strip())
-                output_rows += new_rows
+        if merge_files:
+            say.info('Merging {} files into "{}"'.format(len(merge_files), output_csv))
+            merger = Merger(merge_files, output_csv, buffer_size = buffer_kb * 1024,
+                            max_memory = max_memory * 1024 * 1024)
+            if gui_used:
+                run_with_progress(merger, 'Merging {} files'.format(len(merge_files)))
             else:
-                output_rows.append(row)
-
-        say.info('Writing to "{}"'.format(output_csv))
-        with open(output_csv, 'w', encoding = 'utf8') as csvfile:
-            wr = csv.writer(csvfile, lineterminator = '\n')
-            wr.writerows(output_rows)
+                merger.run()
+            outputs = merger.outputs()
+            if manifest:
+                inputs = [(f, file_sha256(f, buffer_kb * 1024)) for f in merge_files]
+            say.info('Wrote {} rows; dropped {} duplicates'.format(
+                merger.rows_written, merger.duplicates))
+            if merger.conflicts:
+                say.warn('{} items have conflicting values -- see "{}"'.format(
+                    merger.conflicts, merger.conflicts_file()))
+        else:
+            # Read it, massage it, write it.
+            say.info('Reading input from "{}"'.format(input_csv))
+            say.info('Writing to "{}"'.format(output_csv))
+            if sort:
+                say.info('Sorting output rows by {}'.format(sort))
+            summary = Summary() if summarize else None
+            joiner = None
+            if join:
+                say.info('Adding columns from "{}"'.format(join))
+                joiner = Joiner(join, join_on, unmatched_file(output_csv),
+                                max_memory = max_memory * 1024 * 1024,
+                                buffer_size = buffer_kb * 1024)
+            pipeline = Pipeline(input_csv, output_csv, threaded = pipelined,
+                                buffer_size = buffer_kb * 1024, sort = sort,
+                                max_memory = max_memory * 1024 * 1024,
+                                shard_by = shard_by, shard_count = shards,
+                                summary = summary, join = joiner, hash_input = manifest)
+            try:
+                if gui_used:
+                    # Keep the GUI responsive while the work is done.
+                    run_with_progress(pipeline, 'Splitting rows of "{}"'.format(
+                        path.basename(input_csv)))
+                else:
+                    pipeline.run()
+            except UserCancelled:
+                if joiner:
+                    joiner.discard()
+                raise
+            finally:
+                if joiner:
+                    joiner.close()
+            outputs = pipeline.outputs()
+            inputs = [(input_csv, pipeline.input_sha256())]
+            if join and manifest:
+                inputs.append((join, file_sha256(join, buffer_kb * 1024)))
+            for shard, shard_file, count in pipeline.shard_files():
+                say.info('Wrote {} rows to "{}"'.format(count, shard_file))
+            if summary:
+                say.info('Writing summary to "{}"'.format(summary_file(output_csv)))
+                summary.write(summary_file(output_csv), input_csv, output_csv)
+                if summary.mismatched:
+                    say.warn('{} records have different numbers of barcodes and statuses'
+                             .format(summary.mismatched))
+            if joiner and joiner.unmatched:
+                say.warn('{} rows had no match in the lookup table -- see "{}"'
+                         .format(joiner.unmatched, unmatched_file(output_csv)))
+
+        if manifest:
+            say.info('Writing manifest to "{}"'.format(manifest_file(output_csv)))
+            # Record the options that took effect, not just the ones given.
+            options = {'command'    : 'merge' if merge_files else 'split',
+                       'pipelined'  : pipelined,
+                       'buffer_kb'  : buffer_kb,
+                       'sort'       : sort,
+                       'max_memory' : max_memory,
+                       'shard_by'   : shard_by,
+                       'shards'     : shards if shard_by == 'hash' else None,
+                       'join'       : join,
+                       'join_on'    : join_on if join else None,
+                       'summarize'  : summarize}
+            write_manifest(manifest_file(output_csv), inputs, outputs, options)
     except (KeyboardInterrupt, UserCancelled) as ex:
-        if __debug__: log('received {}', ex.__name__)
+        if __debug__: log('received {}', type(ex).__name__)
         exit(say.info_text('Quitting.'))
     except Exception as ex:
         if debug:
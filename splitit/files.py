@@ -25,7 +25,7 @@ import sys
 import subprocess
 import warnings
 import webbrowser
-import wx
+import zipfile
 
 import splitit
 from splitit.debug import log
@@ -157,6 +157,17 @@ def is_csv(infile):
         return False
 
 
+def is_xlsx(infile):
+    '''Return True if the given file is probably an Excel .xlsx file.'''
+    if not zipfile.is_zipfile(infile):
+        return False
+    try:
+        with zipfile.ZipFile(infile) as archive:
+            return 'xl/workbook.xml' in archive.namelist()
+    except zipfile.BadZipFile:
+        return False
+
+
 def relative(file):
     '''Returns a path that is relative to the current directory.  If the
     relative path would require more than one parent step (i.e., ../../*
@@ -263,18 +274,3 @@ def open_url(url):
     if __debug__: log('opening url {}', url)
     webbrowser.open(url)
 
-
-def file_to_open(text, wildcard = 'Any file (*.*)|*.*'):
-    app = wx.App(False)
-    frame = wx.Frame(None, -1, splitit.__title__)
-    fd = wx.FileDialog(frame, text, defaultDir = os.getcwd(), wildcard = wildcard,
-                       style = wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
-    return None if fd.ShowModal() == wx.ID_CANCEL else fd.GetPath()
-
-
-def file_to_save(text):
-    app = wx.App(False)
-    frame = wx.Frame(None, -1, splitit.__title__)
-    fd = wx.FileDialog(frame, text, defaultDir = os.getcwd(),
-                       style = wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
-    return None if fd.ShowModal() == wx.ID_CANCEL else fd.GetPath()
@@ -0,0 +1,189 @@
+'''
+gui.py: the dialogs used when Split It! is run with its GUI
+
+All the dialogs share a single wx.App.  The real work is done by a
+pipeline.Pipeline (or merge.Merger) running in a worker thread, while the main thread runs
+the wx event loop and shows a progress dialog.  The dialog is updated from
+a timer a few times per second (not every time the worker finishes a
+batch), with the number of rows read per second and an estimate of the
+time remaining, or a description of the preparatory work being done (such
+as building the index of a lookup table).  Its Cancel button asks the pipeline to stop, and the
+dialog stays up until the worker has actually finished.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import os
+import threading
+from   time import time
+import wx
+
+import splitit
+from splitit.debug import log
+
+
+# Constants.
+# .............................................................................
+
+_UPDATE_INTERVAL = 250
+'''Time (in msec) between updates of the progress dialog.'''
+
+_RANGE = 1000
+'''Number of steps in the progress bar.'''
+
+_MIN_ESTIMATE_TIME = 2
+'''Time (in sec) that must pass before the time remaining is estimated.'''
+
+_app = None
+'''The wx.App shared by all the dialogs, once it has been created.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class ProgressWindow():
+    '''A progress dialog for a pipeline.Pipeline or merge.Merger run in a
+    worker thread.'''
+
+    def __init__(self, pipeline, message):
+        self._pipeline  = pipeline
+        self._message   = message
+        self._app       = wx_app()
+        self._error     = None
+        self._cancelled = False
+        self._started   = None
+        self._worker    = threading.Thread(target = self._work, name = 'splitit-worker',
+                                           daemon = True)
+        self._dialog    = wx.ProgressDialog(splitit.__title__, self._status(None, 0, 0),
+                                            maximum = _RANGE,
+                                            style = wx.PD_APP_MODAL | wx.PD_CAN_ABORT
+                                            | wx.PD_ELAPSED_TIME)
+        self._timer     = wx.Timer(self._dialog)
+        self._dialog.Bind(wx.EVT_TIMER, self._update, self._timer)
+
+
+    def run(self):
+        if __debug__: log('starting worker thread')
+        self._worker.start()
+        self._timer.Start(_UPDATE_INTERVAL)
+        # The event loop ends when _update() sees that the worker is done.
+        self._app.MainLoop()
+        if __debug__: log('worker thread finished')
+        if self._error:
+            raise self._error
+
+
+    def _work(self):
+        try:
+            self._pipeline.run()
+        except BaseException as ex:
+            self._error = ex
+
+
+    def _update(self, event):
+        if not self._worker.is_alive():
+            self._timer.Stop()
+            self._dialog.Destroy()
+            self._app.ExitMainLoop()
+            return
+        if self._cancelled:
+            # Wait for the pipeline to notice the request to stop.
+            self._dialog.Pulse('Stopping ...')
+            return
+        stage = self._pipeline.stage
+        if stage:
+            elapsed, fraction = 0, None
+        else:
+            # Rates and estimates are based on the time spent on the rows.
+            if self._started is None:
+                self._started = time()
+            elapsed = time() - self._started
+            fraction = self._pipeline.progress()
+        text = self._status(stage, elapsed, fraction)
+        if fraction is None:
+            keep_going, _ = self._dialog.Pulse(text)
+        else:
+            # Reaching the maximum would close the dialog before the end.
+            keep_going, _ = self._dialog.Update(min(int(fraction * _RANGE), _RANGE - 1), text)
+        if not keep_going:
+            if __debug__: log('user clicked cancel')
+            self._cancelled = True
+            self._pipeline.cancel()
+
+
+    def _status(self, stage, elapsed, fraction):
+        if stage:
+            return '{}\n\n{} ...\nTime remaining unknown'.format(self._message, stage)
+        read = self._pipeline.rows_read
+        written = self._pipeline.rows_written
+        rate = read / elapsed if elapsed > 0 else 0
+        text = '{}\n\n{:,} rows read ({:,.0f} rows/sec), {:,} rows written\n'.format(
+            self._message, read, rate, written)
+        if fraction is None:
+            text += 'Time remaining unknown'
+        elif fraction and elapsed >= _MIN_ESTIMATE_TIME:
+            remaining = elapsed * (1 - fraction) / fraction
+            text += 'About {} remaining'.format(_duration(remaining))
+        else:
+            text += 'Estimating time remaining ...'
+        return text
+
+
+# Exported functions.
+# .............................................................................
+
+def wx_app():
+    '''Returns the wx.App for this program, creating it the first time.'''
+    global _app
+    if _app is None:
+        _app = wx.App(False)
+    return _app
+
+
+def file_to_open(text, wildcard = 'Any file (*.*)|*.*'):
+    wx_app()
+    fd = wx.FileDialog(None, text, defaultDir = os.getcwd(), wildcard = wildcard,
+                       style = wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
+    try:
+        return None if fd.ShowModal() == wx.ID_CANCEL else fd.GetPath()
+    finally:
+        fd.Destroy()
+
+
+def file_to_save(text):
+    wx_app()
+    fd = wx.FileDialog(None, text, defaultDir = os.getcwd(),
+                       style = wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+    try:
+        return None if fd.ShowModal() == wx.ID_CANCEL else fd.GetPath()
+    finally:
+        fd.Destroy()
+
+
+def run_with_progress(pipeline, message):
+    '''Runs 'pipeline' (a pipeline.Pipeline or merge.Merger) in a worker
+    thread, showing 'message' and the progress of the work in a dialog with
+    a Cancel button.  Returns when the pipeline is finished.  An exception raised by the pipeline (including
+    UserCancelled, if the user clicks Cancel) is raised again here.'''
+    ProgressWindow(pipeline, message).run()
+
+
+# Internal functions.
+# .............................................................................
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
+    return '{}:{:02}'.format(minutes, seconds)
@@ -0,0 +1,344 @@
+'''
+join.py: enriching split rows with columns from a lookup table
+
+The Joiner class adds columns to each split row by looking up the row's
+barcode or record id in a separate table (for example, an export of item
+records giving the title, location and date last seen of each item).  The
+lookup table is read into a dictionary when it is small enough to fit in
+the memory allowed; otherwise it is loaded into an SQLite database next to
+the lookup file (or in the temporary directory, if that's not writable),
+indexed on the key column.  The database is reused by later runs as long
+as the lookup file does not change.  Rows whose key is not found in the
+table are still written, with empty values in the added columns, and are
+also listed in a separate report.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import csv
+import hashlib
+from   itertools import islice
+import json
+import os
+from   os import path
+import sqlite3
+import tempfile
+
+from splitit.debug import log
+from splitit.exceptions import *
+from splitit.files import writable, is_xlsx
+from splitit.pipeline import read_rows, DEFAULT_BUFFER_SIZE, DEFAULT_BATCH_SIZE
+from splitit.rows import RECORD_ID, BARCODE, is_header
+from splitit.sorting import DEFAULT_MAX_MEMORY
+from splitit.xlsx import xlsx_data_size
+
+
+# Constants.
+# .............................................................................
+
+JOIN_KEYS = ['barcode', 'record']
+'''Columns of the split rows that can be used to look up rows in a table.'''
+
+_KEY_COLUMNS = {
+    'barcode' : ['barcode', 'item barcode'],
+    'record'  : ['record', 'record id', 'record_id', 'recid', 'id', '001', '1'],
+}
+'''Column names recognized as the key column in the header of a lookup table.'''
+
+_DICT_OVERHEAD_RATIO = 6
+'''Rough ratio of the memory used by the dictionary of a lookup table to the
+size of its data.'''
+
+_MAX_QUERY_KEYS = 500
+'''Maximum number of keys looked up in one database query.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class Joiner():
+    '''Adds the columns of 'lookup_file' to rows, matching on 'on'.
+
+    The value of 'on' must be one of the values in JOIN_KEYS.  The lookup
+    file must have a header row; the key column is the one whose name is
+    "barcode" (when joining on barcodes) or "record id" or similar (when
+    joining on record ids), and otherwise the first column.  All the other
+    columns of the lookup file are added to the rows.  If the lookup file
+    is estimated to need more than 'max_memory' bytes in memory, an index
+    on disk is used instead.  Rows whose key is not found are written to
+    'unmatched_file'.
+
+    The lookup table is not read until open() is called (or, failing that,
+    until the first call to enrich()), because reading it or building its
+    index can take a long time.
+    '''
+
+    def __init__(self, lookup_file, on, unmatched_file, max_memory = DEFAULT_MAX_MEMORY,
+                 buffer_size = DEFAULT_BUFFER_SIZE, tmp_dir = None):
+        if on not in JOIN_KEYS:
+            raise ValueError('Unrecognized join key: {}'.format(on))
+        self._lookup_file    = lookup_file
+        self._on             = on
+        self._max_memory     = max_memory
+        self._buffer_size    = buffer_size
+        self._tmp_dir        = tmp_dir
+        self._table          = None
+        self._key_index      = BARCODE if on == 'barcode' else RECORD_ID
+        self._unmatched_file = unmatched_file
+        self._report_file    = None
+        self._reporter       = None
+        self._header         = None
+        self._started        = False
+        self.matched         = 0
+        self.unmatched       = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def open(self, on_stage = None, stop = None):
+        '''Reads the lookup table, or opens or builds its index.  If given,
+        'on_stage' is called with a description of the work being done, and
+        'stop' is a threading.Event; if it is set while the table is being
+        read, UserCancelled is raised.'''
+        if not self._table:
+            self._table = LookupTable(self._lookup_file, self._on, self._max_memory,
+                                      self._buffer_size, self._tmp_dir, on_stage, stop)
+
+
+    def enrich(self, rows):
+        '''Returns a new list of the 'rows' with the looked-up columns added.'''
+        self.open()
+        if not self._started and rows:
+            self._started = True
+            if is_header(rows[0]):
+                self._header = rows[0] + self._table.columns
+                rows = rows[1:]
+                enriched = [self._header]
+            else:
+                enriched = []
+        else:
+            enriched = []
+        found = self._table.lookup(set(self._key(row) for row in rows))
+        empty = [''] * len(self._table.columns)
+        for row in rows:
+            values = found.get(self._key(row))
+            if values is None:
+                self.unmatched += 1
+                self._report(row)
+                values = empty
+            else:
+                self.matched += 1
+            enriched.append(row + values)
+        return enriched
+
+
+    def close(self):
+        if self._table:
+            self._table.close()
+        if self._report_file:
+            self._report_file.close()
+            self._report_file = None
+
+
+    def discard(self):
+        '''Closes the lookup table and removes the report of unmatched rows,
+        for use when the output is abandoned.'''
+        self.close()
+        if path.exists(self._unmatched_file):
+            os.remove(self._unmatched_file)
+
+
+    def _key(self, row):
+        return row[self._key_index].strip() if len(row) > self._key_index else ''
+
+
+    def _report(self, row):
+        if not self._report_file:
+            if __debug__: log('writing unmatched rows to {}', self._unmatched_file)
+            self._report_file = open(self._unmatched_file, 'w', encoding = 'utf8')
+            self._reporter = csv.writer(self._report_file, lineterminator = '\n')
+            if self._header:
+                self._reporter.writerow(self._header[:len(row)])
+        self._reporter.writerow(row)
+
+
+class LookupTable():
+    '''A table of rows from 'lookup_file', keyed on the column for 'on'.
+    The arguments 'on_stage' and 'stop' are as for Joiner.open().'''
+
+    def __init__(self, lookup_file, on, max_memory = DEFAULT_MAX_MEMORY,
+                 buffer_size = DEFAULT_BUFFER_SIZE, tmp_dir = None,
+                 on_stage = None, stop = None):
+        self._lookup_file = lookup_file
+        self._on          = on
+        self._buffer_size = buffer_size
+        self._tmp_dir     = tmp_dir
+        self._on_stage    = on_stage
+        self._stop        = stop
+        self._rows        = None
+        self._db          = None
+        self.columns      = []
+        if self._data_size() * _DICT_OVERHEAD_RATIO <= max_memory:
+            self._load()
+        else:
+            self._open_index()
+
+
+    def lookup(self, keys):
+        '''Returns a dictionary mapping those of 'keys' that are in the table
+        to lists of the values of the other columns.'''
+        if self._rows is not None:
+            return {key: self._rows[key] for key in keys if key in self._rows}
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), _MAX_QUERY_KEYS):
+            chunk = keys[start:start + _MAX_QUERY_KEYS]
+            query = 'SELECT key, value FROM lookup WHERE key IN ({})'.format(
+                ','.join('?' * len(chunk)))
+            for key, value in self._db.execute(query, chunk):
+                found[key] = json.loads(value)
+        return found
+
+
+    def close(self):
+        if self._db:
+            self._db.close()
+            self._db = None
+        self._rows = None
+
+
+    def _entries(self):
+        '''Yields (key, values) for the rows of the lookup file, after setting
+        self.columns from the header row.'''
+        rows = read_rows(self._lookup_file, self._buffer_size)
+        header = next(rows, [])
+        key_index = self._key_column(header)
+        self.columns = header[:key_index] + header[key_index + 1:]
+        width = len(self.columns)
+        for count, row in enumerate(rows):
+            if self._stop and count % DEFAULT_BATCH_SIZE == 0 and self._stop.is_set():
+                raise UserCancelled('Cancelled by user')
+            if len(row) <= key_index or not row[key_index].strip():
+                continue
+            values = row[:key_index] + row[key_index + 1:]
+            # Make every row the same width, so the output columns line up.
+            values = (values + [''] * width)[:width]
+            yield (row[key_index].strip(), values)
+
+
+    def _data_size(self):
+        # An .xlsx file is compressed, so its size on disk says little about
+        # the size of its contents.  The XML is larger than the equivalent
+        # CSV, so this errs on the side of using the index.
+        if is_xlsx(self._lookup_file):
+            return xlsx_data_size(self._lookup_file)
+        return path.getsize(self._lookup_file)
+
+
+    def _key_column(self, header):
+        '''Returns the index of the key column, given the 'header' row.'''
+        names = [name.strip().lower() for name in header]
+        return next((names.index(name) for name in _KEY_COLUMNS[self._on]
+                     if name in names), 0)
+
+
+    def _load(self):
+        if __debug__: log('loading {} into memory', self._lookup_file)
+        self._stage('Reading lookup table "{}"')
+        self._rows = {}
+        for key, values in self._entries():
+            self._rows.setdefault(key, values)
+
+
+    def _open_index(self):
+        index_file = self._index_file()
+        stat = os.stat(self._lookup_file)
+        header = next(read_rows(self._lookup_file, self._buffer_size), [])
+        # An index is only good for the same file contents and the same key.
+        signature = '{} {} {} {}'.format(stat.st_size, stat.st_mtime_ns, self._on,
+                                         self._key_column(header))
+        if path.exists(index_file):
+            db = sqlite3.connect(index_file, check_same_thread = False)
+            try:
+                meta = dict(db.execute('SELECT name, value FROM meta'))
+                if meta.get('signature') == signature:
+                    if __debug__: log('reusing index {}', index_file)
+                    self.columns = json.loads(meta['columns'])
+                    self._db = db
+                    return
+            except sqlite3.DatabaseError:
+                pass
+            db.close()
+        self._build_index(index_file, signature)
+        self._db = sqlite3.connect(index_file, check_same_thread = False)
+
+
+    def _build_index(self, index_file, signature):
+        if __debug__: log('building index {}', index_file)
+        self._stage('Building an index for lookup table "{}"')
+        # Build under a temporary name, so that an interrupted build is never
+        # mistaken for a complete index.
+        partial = index_file + '.partial'
+        if path.exists(partial):
+            os.remove(partial)
+        db = sqlite3.connect(partial)
+        completed = False
+        try:
+            db.execute('CREATE TABLE lookup (key TEXT PRIMARY KEY, value TEXT)')
+            db.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)')
+            entries = ((key, json.dumps(values)) for key, values in self._entries())
+            while True:
+                batch = list(islice(entries, DEFAULT_BATCH_SIZE))
+                if not batch:
+                    break
+                db.executemany('INSERT OR IGNORE INTO lookup VALUES (?, ?)', batch)
+            db.executemany('INSERT INTO meta VALUES (?, ?)',
+                           [('signature', signature), ('columns', json.dumps(self.columns))])
+            db.commit()
+            completed = True
+        finally:
+            db.close()
+            if not completed:
+                os.remove(partial)
+        os.replace(partial, index_file)
+
+
+    def _stage(self, description):
+        if self._on_stage:
+            self._on_stage(description.format(path.basename(self._lookup_file)))
+
+
+    def _index_file(self):
+        directory = path.dirname(path.abspath(self._lookup_file))
+        if writable(directory):
+            return '{}.{}.splitit-index'.format(self._lookup_file, self._on)
+        # Use a name derived from the lookup file's path, so that the index
+        # can be found again by later runs.
+        name = hashlib.sha256(path.abspath(self._lookup_file).encode('utf8')).hexdigest()
+        return path.join(self._tmp_dir or tempfile.gettempdir(),
+                         'splitit-{}-{}.index'.format(name[:16], self._on))
+
+
+# Exported functions.
+# .............................................................................
+
+def unmatched_file(output_file):
+    '''Returns the name of the report of unmatched rows for 'output_file'.'''
+    base, ext = path.splitext(output_file)
+    return '{}-unmatched{}'.format(base, ext or '.csv')
@@ -0,0 +1,55 @@
+'''
+manifest.py: manifests describing the files read and written by Split It!
+
+A manifest is a JSON file that records, for one run of Split It!, the
+version of the program, the time and options of the run, the input files
+(with their SHA-256 checksums), and the output files (with their numbers of
+rows, sizes and SHA-256 checksums).  When a run reads or writes several
+files (e.g., when merging files or dividing the output into shards), all
+of them are listed in the same manifest.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   datetime import datetime, timezone
+import json
+from   os import path
+
+import splitit
+from splitit.debug import log
+
+
+# Exported functions.
+# .............................................................................
+
+def manifest_file(output_file):
+    '''Returns the name of the manifest file for 'output_file'.'''
+    return path.splitext(output_file)[0] + '-manifest.json'
+
+
+def write_manifest(filename, inputs, outputs, options):
+    '''Writes a manifest to 'filename'.  The value of 'inputs' must be a list
+    of tuples (file path, SHA-256 checksum); 'outputs' must be a list of
+    dictionaries as returned by output.OutputFile.outputs(); and 'options'
+    must be a dictionary of the options used for the run.'''
+    if __debug__: log('writing manifest to {}', filename)
+    content = {
+        'splitit version' : splitit.__version__,
+        'created'         : datetime.now(timezone.utc).isoformat(timespec = 'seconds'),
+        'options'         : options,
+        'inputs'          : [{'file': name, 'sha256': sha256} for name, sha256 in inputs],
+        'outputs'         : outputs,
+    }
+    with open(filename, 'w', encoding = 'utf8') as f:
+        json.dump(content, f, indent = 2)
+        f.write('\n')
@@ -0,0 +1,269 @@
+'''
+merge.py: merging several inventory exports into one deduplicated output
+
+A full inventory is sometimes downloaded from caltech.tind.io as several
+partial exports that overlap.  The Merger class splits the rows of every
+input file and merges the results, ordered by record id and barcode.  Rows
+that are exact copies of each other are written only once; when the same
+record id and barcode appear with different values (e.g., a different item
+status), the first version is kept and all the versions are listed in a
+separate conflicts report.
+
+The inputs are combined with a k-way merge, which needs only one row from
+each input at a time.  An input that is not already in order is first put
+in order using an ExternalSorter, which spills to temporary files if the
+input does not fit in its share of the memory limit.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import csv
+import heapq
+from   itertools import chain
+from   operator import itemgetter
+import os
+from   os import path
+import threading
+
+from splitit.debug import log
+from splitit.exceptions import *
+from splitit.output import OutputFile
+from splitit.pipeline import read_rows, DEFAULT_BUFFER_SIZE, DEFAULT_BATCH_SIZE
+from splitit.rows import RECORD_ID, BARCODE, split_row, is_header
+from splitit.sorting import ExternalSorter, DEFAULT_MAX_MEMORY
+
+
+# Exported classes.
+# .............................................................................
+
+class Merger():
+    '''Merges the rows of the files in 'input_files' into 'output_file'.
+
+    The value of 'buffer_size' is the size of the buffers used for reading
+    and writing files, and 'max_memory' is the total number of bytes that
+    may be used for putting unordered inputs in order (divided equally
+    among the inputs that need it).  After run() returns, the attributes
+    'rows_written', 'duplicates' and 'conflicts' hold the number of rows
+    written, the number of duplicate rows dropped, and the number of
+    record id/barcode combinations that had conflicting values.
+
+    Like pipeline.Pipeline, a Merger can be run in one thread and followed
+    from another, using the attributes 'rows_read', 'rows_written' and
+    'stage' and the methods progress() and cancel().
+    '''
+
+    def __init__(self, input_files, output_file, buffer_size = DEFAULT_BUFFER_SIZE,
+                 max_memory = DEFAULT_MAX_MEMORY, tmp_dir = None):
+        self._input_files  = input_files
+        self._output_file  = output_file
+        self._buffer_size  = buffer_size
+        self._max_memory   = max_memory
+        self._tmp_dir      = tmp_dir
+        self._header       = None
+        self._sorters      = []
+        self._report_file  = None
+        self._reporter     = None
+        self._output       = None
+        self._stop         = threading.Event()
+        self.rows_read     = 0
+        self.rows_written  = 0
+        self.duplicates    = 0
+        self.conflicts     = 0
+        self.stage         = None
+
+
+    def run(self):
+        try:
+            self._merge()
+        except UserCancelled:
+            self._remove_output()
+            raise
+        finally:
+            for sorter in self._sorters:
+                sorter.close()
+            self._sorters = []
+
+
+    def cancel(self):
+        '''Asks the merge to stop as soon as possible.  This can be called
+        from any thread; run() will then remove the output written so far
+        and raise UserCancelled.'''
+        if __debug__: log('cancelling merge')
+        self._stop.set()
+
+
+    def progress(self):
+        '''Returns None, because the amount of work left in a merge can't be
+        estimated (see pipeline.Pipeline.progress()).'''
+        return None
+
+
+    def outputs(self):
+        '''Returns a list of dictionaries describing the output file written,
+        with its checksum (see output.OutputFile.outputs()).'''
+        return self._output.outputs() if self._output else []
+
+
+    def conflicts_file(self):
+        '''Returns the path of the report of conflicting rows.'''
+        base, ext = path.splitext(self._output_file)
+        return '{}-conflicts{}'.format(base, ext or '.csv')
+
+
+    def _merge(self):
+        unordered = []
+        for input_file in self._input_files:
+            self.stage = 'Checking the order of "{}"'.format(path.basename(input_file))
+            if not self._in_order(input_file):
+                unordered.append(input_file)
+        self.stage = None
+        if __debug__: log('{} of {} inputs need sorting', len(unordered),
+                          len(self._input_files))
+        memory_share = self._max_memory // max(1, len(unordered))
+        streams = []
+        for index, input_file in enumerate(self._input_files):
+            if input_file in unordered:
+                entries = self._sorted_entries(input_file, memory_share)
+            else:
+                entries = self._entries(input_file)
+            streams.append(_tagged(entries, index))
+        merged = heapq.merge(*streams, key = itemgetter(0))
+        try:
+            self._output = OutputFile(self._output_file, self._buffer_size)
+            with self._output as out:
+                batch = [self._header] if self._header else []
+                for group in _groups(merged):
+                    rows = _distinct(group)
+                    if len(rows) > 1:
+                        self._report(rows)
+                    self.duplicates += len(group) - len(rows)
+                    batch.append(rows[0][1])
+                    self.rows_written += 1
+                    if len(batch) >= DEFAULT_BATCH_SIZE:
+                        out.write(batch)
+                        batch = []
+                out.write(batch)
+        finally:
+            if self._report_file:
+                self._report_file.close()
+
+
+    def _split_rows(self, input_file):
+        '''Yields the split rows of 'input_file', without the header row.'''
+        first = True
+        for row in read_rows(input_file, self._buffer_size):
+            if self._stop.is_set():
+                raise UserCancelled('Cancelled by user')
+            if not self.stage:
+                self.rows_read += 1
+            for new_row in split_row(row):
+                if first:
+                    first = False
+                    if is_header(new_row):
+                        self._header = self._header or new_row
+                        continue
+                yield new_row
+
+
+    def _entries(self, input_file):
+        for row in self._split_rows(input_file):
+            yield (merge_key(row), row)
+
+
+    def _in_order(self, input_file):
+        # This stops at the first row out of order, which usually comes
+        # early in a file that is not in order at all.
+        previous = ''
+        for key, _ in self._entries(input_file):
+            if key < previous:
+                return False
+            previous = key
+        return True
+
+
+    def _sorted_entries(self, input_file, max_memory):
+        sorter = ExternalSorter(merge_key, max_memory, self._tmp_dir)
+        self._sorters.append(sorter)
+        batch = []
+        for row in self._split_rows(input_file):
+            batch.append(row)
+            if len(batch) >= DEFAULT_BATCH_SIZE:
+                sorter.add(batch)
+                batch = []
+        sorter.add(batch)
+        rows = chain.from_iterable(sorter.batches(DEFAULT_BATCH_SIZE))
+        return ((merge_key(row), row) for row in rows)
+
+
+    def _remove_output(self):
+        # Only remove files this run has started writing.
+        files = [self._output_file] if self._output else []
+        if self._report_file:
+            files.append(self.conflicts_file())
+        for file in files:
+            if path.exists(file):
+                if __debug__: log('removing incomplete output {}', file)
+                os.remove(file)
+
+
+    def _report(self, rows):
+        self.conflicts += 1
+        if not self._report_file:
+            if __debug__: log('writing conflicts to {}', self.conflicts_file())
+            self._report_file = open(self.conflicts_file(), 'w', encoding = 'utf8')
+            self._reporter = csv.writer(self._report_file, lineterminator = '\n')
+            self._reporter.writerow(['file'] + (self._header or []))
+        for index, row in rows:
+            self._reporter.writerow([path.basename(self._input_files[index])] + row)
+
+
+# Exported functions.
+# .............................................................................
+
+def merge_key(row):
+    '''Returns the string used to order and match rows in a merge.'''
+    # Record ids and barcodes are usually numbers of different lengths;
+    # padding makes them compare numerically.
+    return '{:0>20} {:0>20}'.format(row[RECORD_ID].strip(), row[BARCODE].strip())
+
+
+# Internal functions.
+# .............................................................................
+
+def _tagged(entries, index):
+    for key, row in entries:
+        yield (key, index, row)
+
+
+def _groups(entries):
+    '''Yields lists of consecutive (key, index, row) entries with equal keys.'''
+    group = []
+    for entry in entries:
+        if group and entry[0] != group[0][0]:
+            yield group
+            group = []
+        group.append(entry)
+    if group:
+        yield group
+
+
+def _distinct(group):
+    '''Returns a list of (input index, row) for the distinct rows in 'group'.'''
+    seen = set()
+    rows = []
+    for _, index, row in group:
+        values = tuple(value.strip() for value in row)
+        if values not in seen:
+            seen.add(values)
+            rows.append((index, row))
+    return rows
@@ -0,0 +1,261 @@
+'''
+output.py: writers for the output files produced by Split It!
+
+OutputFile writes all the rows to a single CSV file.  ShardWriter divides
+the rows among several CSV files ("shards") according to the call number
+class, the item status, or a hash of the record id, and writes an index
+file listing the shards and the number of rows in each.  Both classes have
+the same interface, so the pipeline can use either one.
+
+Both classes compute the SHA-256 checksum of each file from the bytes as
+they are written, so that the output never has to be read again to verify
+it.  The results are available from outputs() after the files are closed.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   collections import OrderedDict
+import csv
+import hashlib
+from   os import path
+import re
+import zlib
+
+from splitit.debug import log
+from splitit.rows import RECORD_ID, STATUS, CALL_NUMBER, is_header, encode_rows
+from splitit.sorting import lc_class
+
+
+# Constants.
+# .............................................................................
+
+SHARD_CHOICES = ['class', 'status', 'hash']
+'''Ways in which rows can be assigned to shards.'''
+
+DEFAULT_SHARD_COUNT = 8
+'''Default number of shards when rows are assigned by hashing.'''
+
+_MAX_OPEN_FILES = 16
+'''Maximum number of shard files kept open at the same time.'''
+
+_SHARD_BUFFER_SIZE = 64 * 1024
+'''Number of bytes accumulated for a shard before it is written to disk.'''
+
+_NON_WORD = re.compile(r'[^A-Za-z0-9]+')
+
+
+# Exported classes.
+# .............................................................................
+
+class OutputFile():
+    '''Writes rows to the CSV file 'output_file', using a write buffer of
+    'buffer_size' bytes.'''
+
+    def __init__(self, output_file, buffer_size):
+        self._path    = output_file
+        self._file    = open(output_file, 'wb', buffering = buffer_size)
+        self._digest  = hashlib.sha256()
+        self._size    = 0
+        self._rows    = 0
+        self._started = False
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def write(self, rows):
+        if not self._started and rows:
+            self._started = True
+            if is_header(rows[0]):
+                self._rows -= 1
+        data = encode_rows(rows)
+        self._file.write(data)
+        self._digest.update(data)
+        self._size += len(data)
+        self._rows += len(rows)
+
+
+    def close(self):
+        self._file.close()
+
+
+    def outputs(self):
+        '''Returns a list containing a dictionary that describes the file
+        written: its path, number of rows (not counting a header row),
+        size in bytes, and SHA-256 checksum.'''
+        return [_description(self._path, self._rows, self._size, self._digest)]
+
+
+class ShardWriter():
+    '''Writes rows to several CSV files, chosen according to 'shard_by'.
+
+    The value of 'shard_by' must be one of the values in SHARD_CHOICES:
+    "class" puts rows in files according to the letters at the start of the
+    LC call number; "status" uses the item status; and "hash" divides the
+    rows among 'shard_count' files using a hash of the record id, so that
+    all the items of a record end up in the same file.  The file names are
+    made by adding the name of the shard to 'output_file' (for example,
+    "inventory-QA.csv"), and the index is written to a file named like
+    "inventory-index.csv".  If the first row written is a header row, it
+    is repeated at the top of every shard.
+
+    Rows are buffered in memory for each shard, and at most _MAX_OPEN_FILES
+    files are kept open at any time, so the number of shards does not
+    matter much for the number of file handles used.
+    '''
+
+    def __init__(self, output_file, shard_by, shard_count = DEFAULT_SHARD_COUNT,
+                 buffer_size = _SHARD_BUFFER_SIZE):
+        if shard_by not in SHARD_CHOICES:
+            raise ValueError('Unrecognized shard type: {}'.format(shard_by))
+        if shard_by == 'hash' and shard_count < 1:
+            raise ValueError('Number of shards must be at least 1')
+        self._base, self._ext = path.splitext(output_file)
+        self._ext          = self._ext or '.csv'
+        self._shard_by     = shard_by
+        self._shard_count  = shard_count
+        self._flush_size   = buffer_size
+        self._digits       = len(str(shard_count - 1))
+        self._header       = None
+        self._started      = False
+        self._pending      = {}               # shard name -> list of rows
+        self._pending_size = {}               # shard name -> approx. bytes
+        self._counts       = OrderedDict()    # shard name -> rows written
+        self._open_files   = OrderedDict()    # shard name -> file object
+        self._created      = set()            # shards whose files exist
+        self._digests      = {}               # shard name -> hashlib object
+        self._sizes        = {}               # shard name -> bytes written
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def write(self, rows):
+        if not self._started and rows:
+            self._started = True
+            if is_header(rows[0]):
+                self._header = rows[0]
+                rows = rows[1:]
+        for row in rows:
+            shard = self._shard_name(row)
+            if shard not in self._pending:
+                self._pending[shard] = []
+                self._pending_size[shard] = 0
+                self._counts.setdefault(shard, 0)
+            self._pending[shard].append(row)
+            self._pending_size[shard] += sum(len(value) for value in row) + len(row)
+            self._counts[shard] += 1
+            if self._pending_size[shard] >= self._flush_size:
+                self._flush(shard)
+
+
+    def close(self):
+        '''Writes out everything that is pending and writes the index file.'''
+        for shard in list(self._pending):
+            self._flush(shard)
+        while self._open_files:
+            _, f = self._open_files.popitem(last = False)
+            f.close()
+        self._write_index()
+
+
+    def shard_files(self):
+        '''Returns a list of tuples (shard name, file path, number of rows).'''
+        return [(shard, self.shard_file(shard), count)
+                for shard, count in sorted(self._counts.items())]
+
+
+    def outputs(self):
+        '''Returns a list of dictionaries describing the shard files written
+        (see OutputFile.outputs()).'''
+        return [_description(filename, count, self._sizes[shard], self._digests[shard])
+                for shard, filename, count in self.shard_files()]
+
+
+    def shard_file(self, shard):
+        return '{}-{}{}'.format(self._base, shard, self._ext)
+
+
+    def index_file(self):
+        return '{}-index{}'.format(self._base, self._ext)
+
+
+    def _shard_name(self, row):
+        if self._shard_by == 'hash':
+            key = row[RECORD_ID].encode('utf8')
+            return str(zlib.crc32(key) % self._shard_count).zfill(self._digits)
+        if self._shard_by == 'class':
+            return lc_class(row[CALL_NUMBER] if len(row) > CALL_NUMBER else '') or 'other'
+        value = row[STATUS] if len(row) > STATUS else ''
+        return _NON_WORD.sub('-', value.strip().lower()).strip('-') or 'none'
+
+
+    def _flush(self, shard):
+        rows = self._pending.pop(shard, None)
+        self._pending_size.pop(shard, None)
+        if not rows:
+            return
+        data = encode_rows(rows)
+        if shard not in self._digests:
+            self._digests[shard] = hashlib.sha256()
+            self._sizes[shard] = 0
+            if self._header:
+                data = encode_rows([self._header]) + data
+        self._file(shard).write(data)
+        self._digests[shard].update(data)
+        self._sizes[shard] += len(data)
+
+
+    def _file(self, shard):
+        if shard in self._open_files:
+            self._open_files.move_to_end(shard)
+            return self._open_files[shard]
+        if len(self._open_files) >= _MAX_OPEN_FILES:
+            _, oldest = self._open_files.popitem(last = False)
+            oldest.close()
+        # The first time a shard is opened, any previous file is replaced.
+        filename = self.shard_file(shard)
+        if shard in self._created:
+            f = open(filename, 'ab')
+        else:
+            if __debug__: log('creating shard file {}', filename)
+            f = open(filename, 'wb')
+            self._created.add(shard)
+        self._open_files[shard] = f
+        return f
+
+
+    def _write_index(self):
+        if __debug__: log('writing shard index {}', self.index_file())
+        with open(self.index_file(), 'w', encoding = 'utf8') as f:
+            writer = csv.writer(f, lineterminator = '\n')
+            writer.writerow(['shard', 'file', 'rows'])
+            for shard, filename, count in self.shard_files():
+                writer.writerow([shard, path.basename(filename), count])
+
+
+# Internal functions.
+# .............................................................................
+
+def _description(filename, rows, size, digest):
+    return {'file': filename, 'rows': rows, 'bytes': size, 'sha256': digest.hexdigest()}
@@ -0,0 +1,437 @@
+'''
+pipeline.py: read, split and write rows of inventory results
+
+The work is done in batches of rows.  In the default (sequential) mode, a
+batch is read, split and written before the next one is read.  In pipelined
+mode, a reader thread parses the input into batches, the calling thread
+splits them, and a writer thread encodes and writes the results.  The
+threads hand batches to each other through bounded queues, so a fast stage
+blocks (rather than consuming unbounded memory) when the next stage falls
+behind.  With a queue depth of 2, each queue acts as a double buffer: one
+batch can be in the hands of the consumer while the next one is waiting.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import csv
+import hashlib
+import io
+from   itertools import islice
+import os
+from   os import path
+import queue
+import threading
+
+from splitit.debug import log
+from splitit.exceptions import *
+from splitit.files import is_xlsx
+from splitit.output import OutputFile, ShardWriter, DEFAULT_SHARD_COUNT
+from splitit.rows import split_rows, is_header
+from splitit.sorting import ExternalSorter, sort_key_function, DEFAULT_MAX_MEMORY
+from splitit.xlsx import xlsx_rows
+
+
+# Constants.
+# .............................................................................
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+'''Default size (in bytes) of the buffers used for reading & writing files.'''
+
+DEFAULT_BATCH_SIZE = 5000
+'''Default number of rows handed from one stage of the pipeline to the next.'''
+
+_QUEUE_DEPTH = 2
+'''Maximum number of batches waiting between two stages of the pipeline.'''
+
+_POLL_INTERVAL = 0.1
+'''Time (in sec) that threads wait on a queue before checking for a stop.'''
+
+_END = object()
+'''Marker put on a queue to indicate there are no more batches coming.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class Pipeline():
+    '''Reads an inventory file, splits compound rows, and writes the results.
+
+    The input can be a CSV file or an Excel .xlsx file; the output is CSV.
+
+    If 'threaded' is True, reading and writing are done in background
+    threads so that file I/O overlaps with the splitting work.  The value of
+    'buffer_size' is the size (in bytes) of the buffers used for reading the
+    input file and writing the output file.  The value of 'batch_size' is
+    the number of rows handled as a unit by each stage of the pipeline.
+
+    If 'sort' is given, it names the order in which the output rows are
+    written (see sorting.sort_key_function()).  A header row at the top of
+    the input stays at the top of the output.  Sorting needs all the rows
+    before anything can be written; rows beyond 'max_memory' bytes are put
+    in temporary files, in the directory 'tmp_dir' if it is given.
+
+    If 'shard_by' is given, the output is divided among several files
+    instead of being written to 'output_file' (see output.ShardWriter).
+    The value of 'shard_count' is the number of files used when 'shard_by'
+    is "hash".
+
+    If 'summary' is given, it must be a summary.Summary object; the rows
+    are counted in it as they are split.  If 'join' is given, it must be a
+    join.Joiner object; it adds columns to the rows after they are split
+    (and before they are sorted or written).  The joiner's lookup table is
+    opened at the start of run(), so that it happens in the same thread as
+    the rest of the work.  If 'hash_input' is True, the
+    SHA-256 checksum of the input file is computed while it is read, and
+    is available afterwards from input_sha256().
+
+    While run() is working, other threads can follow its progress using
+    the attributes 'rows_read' and 'rows_written' and the method progress().
+    The attribute 'stage' describes preparatory work (such as building the
+    index of a lookup table) while it is being done, and is None otherwise.
+    '''
+
+    def __init__(self, input_file, output_file, threaded = False,
+                 buffer_size = DEFAULT_BUFFER_SIZE, batch_size = DEFAULT_BATCH_SIZE,
+                 sort = None, max_memory = DEFAULT_MAX_MEMORY, tmp_dir = None,
+                 shard_by = None, shard_count = DEFAULT_SHARD_COUNT, summary = None,
+                 join = None, hash_input = False):
+        self._input_file  = input_file
+        self._output_file = output_file
+        self._threaded    = threaded
+        self._buffer_size = buffer_size
+        self._batch_size  = batch_size
+        self._sort        = sort
+        self._max_memory  = max_memory
+        self._tmp_dir     = tmp_dir
+        self._shard_by    = shard_by
+        self._shard_count = shard_count
+        self._summary     = summary
+        self._join        = join
+        self._digest      = hashlib.sha256() if hash_input else None
+        self._output      = None
+        self._stop        = threading.Event()
+        self._error       = None
+        self._input_size  = None
+        self._bytes_read  = 0
+        self._rows_split  = 0
+        self.rows_read    = 0
+        self.rows_written = 0
+        self.stage        = None
+
+
+    def run(self):
+        '''Performs the work, and returns when all the output is written.
+        Exceptions raised while reading or writing (including in background
+        threads) are raised again in the caller's thread.'''
+        # The progress of reading an .xlsx file can't be measured in bytes.
+        self._input_size = None if is_xlsx(self._input_file) else path.getsize(self._input_file)
+        if self._join:
+            self._join.open(self._set_stage, self._stop)
+            self._set_stage(None)
+            if self._error:
+                raise self._error
+        if self._threaded:
+            self._run_threaded()
+        else:
+            self._run_sequential()
+        if isinstance(self._error, UserCancelled):
+            self._remove_output()
+        if self._error:
+            raise self._error
+
+
+    def cancel(self):
+        '''Asks the pipeline to stop as soon as possible.  This can be called
+        from any thread; run() will then remove the output written so far
+        and raise UserCancelled.'''
+        if __debug__: log('cancelling pipeline')
+        self._fail(UserCancelled('Cancelled by user'))
+
+
+    def progress(self):
+        '''Returns an estimate of the fraction of the work done so far, from
+        0 to 1, or None if it can't be estimated (as for .xlsx input files).
+        This can be called from any thread while run() is working.'''
+        if self._input_size is None or self.stage:
+            return None
+        read = min(1, self._bytes_read / self._input_size) if self._input_size else 1
+        if not self._sort:
+            return read
+        # Sorted output is only written after all the input has been read,
+        # so count reading as the first half of the work and writing as the
+        # second half.
+        written = min(1, self.rows_written / self._rows_split) if self._rows_split else 0
+        return (read + (written if read == 1 else 0)) / 2
+
+
+    def shard_files(self):
+        '''Returns a list of tuples (shard name, file path, number of rows)
+        describing the files written, if the output was divided into shards,
+        or an empty list otherwise.'''
+        if isinstance(self._output, ShardWriter):
+            return self._output.shard_files()
+        return []
+
+
+    def outputs(self):
+        '''Returns a list of dictionaries describing the output files
+        written, with their checksums (see output.OutputFile.outputs()).'''
+        return self._output.outputs() if self._output else []
+
+
+    def input_sha256(self):
+        '''Returns the SHA-256 checksum of the input file, if the pipeline
+        was created with 'hash_input' set to True, or None otherwise.'''
+        return self._digest.hexdigest() if self._digest else None
+
+
+    def _open_output(self):
+        if self._shard_by:
+            self._output = ShardWriter(self._output_file, self._shard_by, self._shard_count)
+        else:
+            self._output = OutputFile(self._output_file, self._buffer_size)
+        return self._output
+
+
+    def _set_stage(self, description):
+        self.stage = description
+
+
+    def _remove_output(self):
+        files = [entry['file'] for entry in self.outputs()]
+        if isinstance(self._output, ShardWriter):
+            files.append(self._output.index_file())
+        for file in files:
+            if path.exists(file):
+                if __debug__: log('removing incomplete output {}', file)
+                os.remove(file)
+
+
+    def _fail(self, ex):
+        # Only the first problem is kept; the rest are usually consequences.
+        if not self._error:
+            self._error = ex
+        self._stop.set()
+
+
+    def _run_sequential(self):
+        if __debug__: log('running sequentially')
+        with self._open_output() as out:
+            for rows in self._process(self._batches()):
+                if self._stop.is_set():
+                    return
+                self._write(out, rows)
+
+
+    def _run_threaded(self):
+        if __debug__: log('running with reader & writer threads')
+        to_split = queue.Queue(maxsize = _QUEUE_DEPTH)
+        to_write = queue.Queue(maxsize = _QUEUE_DEPTH)
+        reader = threading.Thread(target = self._guarded, args = (self._reader, to_split),
+                                  name = 'splitit-reader', daemon = True)
+        writer = threading.Thread(target = self._guarded, args = (self._writer, to_write),
+                                  name = 'splitit-writer', daemon = True)
+        reader.start()
+        writer.start()
+        # The queues are bounded, so a thread blocked on one of them would
+        # hang forever if the other side went away.  That's why _fail() sets
+        # the stop event: _put() and _get() check it while they wait.
+        self._guarded(self._splitter, to_split, to_write)
+        reader.join()
+        writer.join()
+
+
+    def _guarded(self, func, *args):
+        try:
+            func(*args)
+        except _Stopped:
+            pass
+        except BaseException as ex:
+            if __debug__: log('{} in {}', type(ex).__name__, func.__name__)
+            self._fail(ex)
+
+
+    def _reader(self, to_split):
+        for batch in self._batches():
+            self._put(to_split, batch)
+        self._put(to_split, _END)
+
+
+    def _splitter(self, to_split, to_write):
+        for rows in self._process(self._queued(to_split)):
+            self._put(to_write, rows)
+        self._put(to_write, _END)
+
+
+    def _writer(self, to_write):
+        with self._open_output() as out:
+            while True:
+                rows = self._get(to_write)
+                if rows is _END:
+                    break
+                self._write(out, rows)
+
+
+    def _write(self, out, rows):
+        out.write(rows)
+        self.rows_written += len(rows)
+
+
+    def _process(self, batches):
+        '''Yields lists of output rows for the given batches of input rows.'''
+        if not self._sort:
+            yield from self._split(batches)
+            return
+        key = sort_key_function(self._sort)
+        with ExternalSorter(key, self._max_memory, self._tmp_dir) as sorter:
+            first = True
+            for rows in self._split(batches):
+                if first and rows:
+                    if is_header(rows[0]):
+                        yield [rows.pop(0)]
+                    first = False
+                sorter.add(rows)
+                if self._stop.is_set():
+                    return
+            yield from sorter.batches(self._batch_size)
+
+
+    def _split(self, batches):
+        for batch in batches:
+            rows = split_rows(batch)
+            if self._summary:
+                self._summary.add(batch, rows)
+            if self._join:
+                rows = self._join.enrich(rows)
+            self._rows_split += len(rows)
+            yield rows
+
+
+    def _queued(self, q):
+        while True:
+            batch = self._get(q)
+            if batch is _END:
+                return
+            yield batch
+
+
+    def _batches(self):
+        rows = read_rows(self._input_file, self._buffer_size, self._digest,
+                         self._count_bytes)
+        while True:
+            batch = list(islice(rows, self._batch_size))
+            if not batch:
+                return
+            self.rows_read += len(batch)
+            yield batch
+
+
+    def _count_bytes(self, count):
+        self._bytes_read += count
+
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout = _POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+        raise _Stopped()
+
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout = _POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        raise _Stopped()
+
+
+# Exported functions.
+# .............................................................................
+
+def read_rows(input_file, buffer_size = DEFAULT_BUFFER_SIZE, digest = None,
+              on_read = None):
+    '''Yields the rows of 'input_file', which can be a CSV or .xlsx file.
+    If 'digest' is given, it must be a hashlib object, and it is updated
+    with the bytes of the file.  For CSV files, this is done as the file is
+    read; .xlsx files are not read sequentially, so for them the checksum
+    is computed first, in a separate pass over the file.  If 'on_read' is
+    given, it is called with the number of bytes read each time a CSV file
+    is read from (it is not used for .xlsx files).'''
+    if is_xlsx(input_file):
+        if digest:
+            _update_digest(digest, input_file, buffer_size)
+        yield from xlsx_rows(input_file)
+    else:
+        raw = io.FileIO(input_file)
+        if digest or on_read:
+            raw = _TrackingReader(raw, digest, on_read)
+        with io.TextIOWrapper(io.BufferedReader(raw, buffer_size),
+                              encoding = 'utf8', newline = '') as csvfile:
+            yield from csv.reader(csvfile)
+
+
+def file_sha256(input_file, buffer_size = DEFAULT_BUFFER_SIZE):
+    '''Returns the SHA-256 checksum of the contents of 'input_file'.'''
+    digest = hashlib.sha256()
+    _update_digest(digest, input_file, buffer_size)
+    return digest.hexdigest()
+
+
+# Internal functions.
+# .............................................................................
+
+def _update_digest(digest, input_file, buffer_size):
+    with open(input_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(buffer_size), b''):
+            digest.update(chunk)
+
+
+# Internal classes.
+# .............................................................................
+
+class _TrackingReader(io.RawIOBase):
+    '''Wraps a raw binary file, updates a digest with the bytes read (if
+    'digest' is not None) and reports the number of bytes read to 'on_read'
+    (if it is not None).'''
+
+    def __init__(self, raw, digest = None, on_read = None):
+        self._raw = raw
+        self._digest = digest
+        self._on_read = on_read
+
+
+    def readable(self):
+        return True
+
+
+    def readinto(self, buf):
+        count = self._raw.readinto(buf)
+        if count and self._digest:
+            self._digest.update(memoryview(buf)[:count])
+        if count and self._on_read:
+            self._on_read(count)
+        return count
+
+
+    def close(self):
+        self._raw.close()
+        super().close()
+
+
+class _Stopped(Exception):
+    '''Raised inside the pipeline to unwind a stage after a stop request.'''
+    pass
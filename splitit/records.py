@@ -0,0 +1,171 @@
+'''
+records.py: compact in-memory storage for rows of inventory data
+
+Holding split rows in memory as lists of strings is expensive: every row
+costs a list object plus one string object per column, and the values that
+are repeated over and over (an item status like "on shelf", or the call
+number shared by all the items of a compound record) are stored again in
+every row.  RecordStore keeps the rows by column instead.  Columns whose
+values are numbers (the record id and barcode) are kept as 64-bit integers
+in an array, and the other columns are dictionary-encoded: each distinct
+value is stored once, and each row holds only a small integer code.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   array import array
+import sys
+
+from splitit.rows import RECORD_ID, BARCODE
+
+
+# Constants.
+# .............................................................................
+
+_COLUMNS = 6
+'''Number of columns in the rows exported by caltech.tind.io.'''
+
+_NUMERIC_COLUMNS = [RECORD_ID, BARCODE]
+
+_NOT_A_NUMBER = 2**64 - 1
+'''Value stored in a NumberColumn in place of a value kept as a string.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class EncodedColumn():
+    '''A column of strings, each distinct value stored only once.'''
+
+    def __init__(self):
+        self._codes  = array('I')
+        self._values = []
+        self._index  = {}
+        self._bytes  = 0
+
+
+    def __len__(self):
+        return len(self._codes)
+
+
+    def __getitem__(self, i):
+        return self._values[self._codes[i]]
+
+
+    def append(self, value):
+        code = self._index.get(value)
+        if code is None:
+            code = len(self._values)
+            self._index[value] = code
+            self._values.append(value)
+            # The string, plus its entries in the list and the dict.
+            self._bytes += sys.getsizeof(value) + 8 + 100
+        self._codes.append(code)
+
+
+    def nbytes(self):
+        '''Returns an estimate of the memory used by this column, in bytes.'''
+        return self._bytes + self._codes.itemsize * len(self._codes)
+
+
+class NumberColumn():
+    '''A column of strings that are usually nonnegative integers.  Values
+    that are not in the canonical form of an integer (e.g., "", "007" or
+    "12a") are kept as strings on the side, so every value comes back out
+    exactly as it went in.'''
+
+    def __init__(self):
+        self._numbers = array('Q')
+        self._others  = {}
+        self._bytes   = 0
+
+
+    def __len__(self):
+        return len(self._numbers)
+
+
+    def __getitem__(self, i):
+        number = self._numbers[i]
+        if number == _NOT_A_NUMBER:
+            return self._others[i if i >= 0 else len(self._numbers) + i]
+        return str(number)
+
+
+    def append(self, value):
+        if value.isdigit() and value.isascii() and (value == '0' or value[0] != '0'):
+            number = int(value)
+            if number < _NOT_A_NUMBER:
+                self._numbers.append(number)
+                return
+        self._others[len(self._numbers)] = value
+        self._numbers.append(_NOT_A_NUMBER)
+        self._bytes += sys.getsizeof(value) + 100
+
+
+    def nbytes(self):
+        '''Returns an estimate of the memory used by this column, in bytes.'''
+        return self._bytes + self._numbers.itemsize * len(self._numbers)
+
+
+class RecordStore():
+    '''A list-like collection of rows, stored compactly by column.
+
+    Rows are added with append() or extend() and come back out as lists of
+    strings, equal to the ones that were added.  Rows with more columns
+    than usual are accepted; the extra values are kept on the side.
+    '''
+
+    def __init__(self):
+        self._columns = [NumberColumn() if index in _NUMERIC_COLUMNS else EncodedColumn()
+                         for index in range(_COLUMNS)]
+        self._widths  = array('B')
+        self._extras  = {}
+        self._bytes   = 0
+
+
+    def __len__(self):
+        return len(self._widths)
+
+
+    def __getitem__(self, i):
+        width = self._widths[i]
+        row = [column[i] for column in self._columns[:width]]
+        if width > _COLUMNS:
+            row += self._extras[i if i >= 0 else len(self._widths) + i]
+        return row
+
+
+    def __iter__(self):
+        for i in range(len(self._widths)):
+            yield self[i]
+
+
+    def append(self, row):
+        width = len(row)
+        for index, column in enumerate(self._columns):
+            column.append(row[index] if index < width else '')
+        if width > _COLUMNS:
+            self._extras[len(self._widths)] = row[_COLUMNS:]
+            self._bytes += sum(sys.getsizeof(value) for value in row[_COLUMNS:]) + 100
+        self._widths.append(min(width, _COLUMNS + 1))
+
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+
+    def nbytes(self):
+        '''Returns an estimate of the memory used by the rows, in bytes.'''
+        return (self._bytes + len(self._widths)
+                + sum(column.nbytes() for column in self._columns))
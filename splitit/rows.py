@@ -0,0 +1,94 @@
+'''
+rows.py: utilities for working with rows of inventory data
+
+The rows exported by caltech.tind.io have the following columns (counting
+from 0): the record id, the barcode, the item status, an unused column, the
+call number, and another unused column.  In compound rows, the barcode and
+status columns hold semicolon-separated lists of parallel values.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import csv
+import io
+import os
+
+
+# Constants.
+# .............................................................................
+
+RECORD_ID   = 0
+BARCODE     = 1
+STATUS      = 2
+CALL_NUMBER = 4
+
+
+# Exported functions.
+# .............................................................................
+
+def split_row(row):
+    '''Returns a list of the rows obtained by splitting the compound values
+    in 'row', or an empty list if 'row' is blank.  If the row has fewer
+    status values than barcodes, the missing status values are left empty;
+    extra status values are dropped.'''
+    # Example of possible input:
+    #
+    # 574524,35047011136967,on shelf,,QA7 .A664 1991,
+    # 501345,350470002009169; 35047010046266,on shelf; on shelf,,QA7 .A67 1983,
+    if not row or row[0] == '':
+        return []
+    if ';' not in row[1]:
+        return [row]
+    new_rows = []
+    for part in row[1].split(';'):
+        new_rows.append([row[0], part.strip()])
+    statuses = row[2].split(';')
+    for index, new_row in enumerate(new_rows):
+        new_row.append(statuses[index].strip() if index < len(statuses) else '')
+    for new_row in new_rows:
+        new_row.append(row[3].strip())
+        new_row.append(row[4].strip())
+        new_row.append(row[5].strip())
+    return new_rows
+
+
+def split_rows(rows):
+    '''Returns a list of the rows obtained by splitting every row in 'rows'.'''
+    output_rows = []
+    for row in rows:
+        output_rows += split_row(row)
+    return output_rows
+
+
+def part_counts(row):
+    '''Returns a tuple (number of barcodes, number of status values) for the
+    compound values in 'row'.'''
+    return (row[BARCODE].count(';') + 1, row[STATUS].count(';') + 1)
+
+
+def is_header(row):
+    '''Returns True if 'row' looks like the row of column names that TIND
+    puts at the top of its exports (e.g., "1,barcode,itemstatus,...").'''
+    if len(row) < 2:
+        return False
+    value = row[BARCODE].strip()
+    # A data row can have an empty barcode, so that alone doesn't count.
+    return value.lower() == 'barcode' or (value != '' and not any(c.isdigit() for c in value))
+
+
+def encode_rows(rows):
+    '''Returns the bytes of 'rows' formatted as CSV and encoded in UTF-8.'''
+    # The line terminator is what a text-mode file would have produced.
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator = os.linesep).writerows(rows)
+    return buf.getvalue().encode('utf8')
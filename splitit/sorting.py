@@ -0,0 +1,259 @@
+'''
+sorting.py: sorting of rows, in memory or using temporary files
+
+Rows are collected in memory until their estimated size exceeds a given
+limit.  At that point, the rows collected so far are sorted and written to
+a temporary file (a "run"), and collection starts over.  When all the rows
+have been added, the runs are merged to produce the rows in sorted order.
+If everything fits in memory, no temporary files are written at all.
+
+The rows held in memory are kept in a RecordStore, which takes several
+times less memory than lists of strings.  Their sort keys are not kept:
+keys are often unique to each row (as in merges, where the key is the
+record id plus the barcode), and would then take more memory than the rows
+themselves.  The keys are computed when a batch of rows is sorted, and are
+stored alongside the rows in the runs so that merging does not need to
+compute them again.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   array import array
+import csv
+import heapq
+from   itertools import islice
+from   operator import itemgetter
+import os
+from   os import path
+import re
+import shutil
+import sys
+import tempfile
+
+from splitit.debug import log
+from splitit.records import RecordStore
+from splitit.rows import CALL_NUMBER
+
+
+# Constants.
+# .............................................................................
+
+DEFAULT_MAX_MEMORY = 256 * 1024 * 1024
+'''Default amount of memory (in bytes) that a sort may use for rows.'''
+
+_MAX_FAN_IN = 64
+'''Maximum number of run files merged at one time.'''
+
+_SORT_OVERHEAD = 44
+'''Bytes used per row while rows are sorted, apart from the key itself: the
+list entries for the key and the row number, and the row number itself.'''
+
+_LC_CALL_NUMBER = re.compile(r'^\s*([A-Z]{1,3})\s*(\d+)(?:\.(\d+))?(.*)$', re.IGNORECASE)
+_SEPARATORS = re.compile(r'[\s.,]+')
+_TOKEN_PARTS = re.compile(r'\d+|\D+')
+
+
+# Exported functions.
+# .............................................................................
+
+def lc_sort_key(call_number):
+    '''Returns a string that can be used to sort Library of Congress call
+    numbers in shelf order.  Plain string comparison of call numbers gets
+    some cases wrong: for example, "QA76" must come after "QA7 .A664" and
+    after "QA9", but it comes before them in a string sort.  The key built
+    here pads class numbers so that they compare numerically, while cutter
+    numbers (like ".A664") keep comparing as decimal fractions.  Values
+    that do not look like LC call numbers sort after all the ones that do,
+    and empty values sort last.'''
+    text = call_number.strip().upper()
+    if not text:
+        return '2'
+    parts = _LC_CALL_NUMBER.match(text)
+    if not parts:
+        return '1' + text
+    letters, integer, fraction, rest = parts.groups()
+    # Spaces sort before digits and letters, so a shorter value compares
+    # lower than a longer one that starts the same way (e.g., "Q" < "QA").
+    key = '0{:<3}{:0>6}.{} '.format(letters, integer, fraction or '')
+    return key + ' '.join(_token_key(token) for token in _SEPARATORS.split(rest) if token)
+
+
+def lc_class(call_number):
+    '''Returns the class letters at the start of an LC call number (e.g.,
+    "QA" for "QA7 .A664 1991"), or None if it is not an LC call number.'''
+    parts = _LC_CALL_NUMBER.match(call_number.upper())
+    return parts.group(1) if parts else None
+
+
+def sort_key_function(name):
+    '''Returns a function that computes the sort key of a row, for the sort
+    order identified by 'name'.  Currently only "callnumber" is recognized.'''
+    if name == 'callnumber':
+        return lambda row: lc_sort_key(row[CALL_NUMBER] if len(row) > CALL_NUMBER else '')
+    raise ValueError('Unrecognized sort order: {}'.format(name))
+
+
+# Exported classes.
+# .............................................................................
+
+class ExternalSorter():
+    '''Sorts rows using the function 'key', using temporary files if needed.
+
+    Rows are added using add(); when all rows have been added, batches()
+    yields the sorted rows.  The value of 'max_memory' is the approximate
+    number of bytes of row data to keep in memory before writing a sorted
+    run to a temporary file.  The sort is stable.  Callers should call
+    close() (or use the object as a context manager) to remove temporary
+    files.
+    '''
+
+    def __init__(self, key, max_memory = DEFAULT_MAX_MEMORY, tmp_dir = None):
+        self._key        = key
+        self._max_memory = max_memory
+        self._tmp_dir    = tmp_dir
+        self._run_dir    = None
+        self._runs       = []
+        self._pending    = RecordStore()
+        self._key_bytes  = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def add(self, rows):
+        '''Adds the rows in the list 'rows' to the rows being sorted.'''
+        self._pending.extend(rows)
+        if not self._key_bytes and rows:
+            # The keys are needed all at once when the rows are sorted, so
+            # leave room for them.
+            self._key_bytes = sys.getsizeof(self._key(rows[0])) + _SORT_OVERHEAD
+        needed = self._pending.nbytes() + len(self._pending) * self._key_bytes
+        if needed >= self._max_memory:
+            self._spill()
+
+
+    def batches(self, batch_size):
+        '''Yields lists of at most 'batch_size' rows, in sorted order.'''
+        if not self._runs:
+            if __debug__: log('sorting {} rows in memory', len(self._pending))
+            # The keys are not needed after sorting, so don't keep them
+            # while the rows are handed out.
+            order, _ = self._sorted_order()
+            rows = (self._pending[i] for i in order)
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    return
+                yield batch
+        if len(self._pending):
+            self._spill()
+        while len(self._runs) > _MAX_FAN_IN:
+            self._merge_runs()
+        if __debug__: log('merging {} runs', len(self._runs))
+        files = [open(run, newline = '', encoding = 'utf8') for run in self._runs]
+        try:
+            merged = heapq.merge(*[_run_entries(f) for f in files], key = itemgetter(0))
+            rows = (row for _, row in merged)
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    return
+                yield batch
+        finally:
+            for f in files:
+                f.close()
+
+
+    def close(self):
+        '''Removes any temporary files created by this sorter.'''
+        self._pending = RecordStore()
+        self._runs = []
+        if self._run_dir and path.exists(self._run_dir):
+            if __debug__: log('removing {}', self._run_dir)
+            shutil.rmtree(self._run_dir, ignore_errors = True)
+        self._run_dir = None
+
+
+    def _sorted_order(self):
+        '''Returns a tuple (order, keys), where 'keys' is a list of the keys
+        of the rows held in memory and 'order' is an array of the indexes
+        of the rows in sorted order.'''
+        keys = [self._key(row) for row in self._pending]
+        order = array('I', sorted(range(len(keys)), key = keys.__getitem__))
+        return order, keys
+
+
+    def _sorted_pending(self):
+        '''Yields (key, row) for the rows held in memory, in sorted order.'''
+        order, keys = self._sorted_order()
+        for i in order:
+            yield (keys[i], self._pending[i])
+
+
+    def _spill(self):
+        self._write_run(self._sorted_pending())
+        self._pending = RecordStore()
+
+
+    def _merge_runs(self):
+        # Merge the oldest runs first; heapq.merge keeps equal keys in the
+        # order of the runs, so this preserves the stability of the sort.
+        oldest = self._runs[:_MAX_FAN_IN]
+        self._runs = self._runs[_MAX_FAN_IN:]
+        files = [open(run, newline = '', encoding = 'utf8') for run in oldest]
+        try:
+            merged = heapq.merge(*[_run_entries(f) for f in files], key = itemgetter(0))
+            self._write_run(merged, position = 0)
+        finally:
+            for f in files:
+                f.close()
+        for run in oldest:
+            os.remove(run)
+
+
+    def _write_run(self, entries, position = None):
+        if not self._run_dir:
+            self._run_dir = tempfile.mkdtemp(prefix = 'splitit-', dir = self._tmp_dir)
+        handle, run = tempfile.mkstemp(suffix = '.csv', dir = self._run_dir)
+        with open(handle, 'w', newline = '', encoding = 'utf8') as f:
+            writer = csv.writer(f)
+            writer.writerows([key] + row for key, row in entries)
+        if position is None:
+            self._runs.append(run)
+        else:
+            self._runs.insert(position, run)
+        if __debug__: log('wrote sorted run {}', run)
+
+
+# Internal functions.
+# .............................................................................
+
+def _token_key(token):
+    # Numbers outside the class number (years, volume numbers, etc.) are
+    # compared numerically.  Digits following a letter are part of a cutter
+    # number, which is a decimal fraction, and are left alone.
+    pieces = _TOKEN_PARTS.findall(token)
+    if pieces[0].isdigit():
+        pieces[0] = pieces[0].zfill(6)
+    return ''.join(pieces)
+
+
+def _run_entries(f):
+    for row in csv.reader(f):
+        yield (row[0], row[1:])
+
@@ -0,0 +1,134 @@
+'''
+summary.py: counts of the contents of an inventory, gathered while splitting
+
+The Summary class is handed each batch of input rows together with the
+rows produced by splitting them, and keeps running totals: the numbers of
+rows read and written, how many records are simple or compound, how many
+barcodes the records have, how many items have each status, and how many
+items are in each Library of Congress class.  Only counters are kept (plus
+a short list of examples of problem records), so the memory needed does
+not depend on the size of the input.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   collections import Counter
+import json
+from   os import path
+
+import splitit
+from splitit.debug import log
+from splitit.rows import RECORD_ID, STATUS, CALL_NUMBER, part_counts, is_header
+from splitit.sorting import lc_class
+
+
+# Constants.
+# .............................................................................
+
+_MAX_EXAMPLES = 100
+'''Maximum number of record id's listed for records with mismatched parts.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class Summary():
+    '''Running totals describing the rows of an inventory.'''
+
+    def __init__(self):
+        self.rows_read      = 0
+        self.rows_written   = 0
+        self.simple         = 0
+        self.compound       = 0
+        self.mismatched     = 0
+        self.mismatched_ids = []
+        self.barcodes       = Counter()    # number of barcodes -> records
+        self.statuses       = Counter()    # item status -> items
+        self.classes        = Counter()    # LC class -> items
+        self._started       = False
+
+
+    def add(self, input_rows, output_rows):
+        '''Counts a batch of 'input_rows' and the 'output_rows' obtained by
+        splitting them.  A header row at the top of the input is skipped.'''
+        if not self._started:
+            input_rows = [row for row in input_rows if row and row[0] != '']
+            if input_rows:
+                self._started = True
+                if is_header(input_rows[0]):
+                    input_rows = input_rows[1:]
+                    output_rows = output_rows[1:]
+        for row in input_rows:
+            if not row or row[0] == '':
+                continue
+            self.rows_read += 1
+            num_barcodes, num_statuses = part_counts(row)
+            if num_barcodes > 1:
+                self.compound += 1
+            else:
+                self.simple += 1
+            self.barcodes[num_barcodes] += 1
+            if num_barcodes != num_statuses:
+                self.mismatched += 1
+                if len(self.mismatched_ids) < _MAX_EXAMPLES:
+                    self.mismatched_ids.append(row[RECORD_ID])
+        for row in output_rows:
+            self.rows_written += 1
+            self.statuses[row[STATUS].strip() if len(row) > STATUS else ''] += 1
+            call_number = row[CALL_NUMBER] if len(row) > CALL_NUMBER else ''
+            self.classes[lc_class(call_number) or 'other'] += 1
+
+
+    def as_dict(self):
+        '''Returns the totals as a dictionary, suitable for writing as JSON.'''
+        return {
+            'rows read'           : self.rows_read,
+            'rows written'        : self.rows_written,
+            'simple records'      : self.simple,
+            'compound records'    : self.compound,
+            'mismatched records'  : self.mismatched,
+            'mismatched examples' : self.mismatched_ids,
+            'barcodes per record' : _sorted_dict(self.barcodes),
+            'items per status'    : _sorted_dict(self.statuses),
+            'items per class'     : _sorted_dict(self.classes),
+        }
+
+
+    def write(self, summary_file, input_file, output_file):
+        '''Writes the summary in JSON format to 'summary_file'.'''
+        if __debug__: log('writing summary to {}', summary_file)
+        content = {
+            'input file'      : input_file,
+            'output file'     : output_file,
+            'splitit version' : splitit.__version__,
+        }
+        content.update(self.as_dict())
+        with open(summary_file, 'w', encoding = 'utf8') as f:
+            json.dump(content, f, indent = 2)
+            f.write('\n')
+
+
+# Exported functions.
+# .............................................................................
+
+def summary_file(output_file):
+    '''Returns the name of the summary file for 'output_file'.'''
+    return path.splitext(output_file)[0] + '-summary.json'
+
+
+# Internal functions.
+# .............................................................................
+
+def _sorted_dict(counter):
+    # JSON object keys must be strings.  Sort numbers numerically.
+    return {str(key) or '(none)': counter[key] for key in sorted(counter)}
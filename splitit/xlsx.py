@@ -0,0 +1,298 @@
+'''
+xlsx.py: streaming reader for Excel (.xlsx) spreadsheets
+
+An .xlsx file is a zip archive of XML documents.  The cell values of each
+worksheet are stored in a separate XML file, and most string values are
+stored only once, in a shared-strings table that the cells refer to by
+index.  This module reads the shared-strings table and then parses the XML
+of the first worksheet incrementally, discarding each row after it has been
+returned, so that the memory needed does not grow with the number of rows.
+
+Excel stores dates and times as numbers (days since the end of 1899), and
+only the number format of a cell's style says that it's a date.  The styles
+are read from the workbook first, and the values of cells whose number
+format is a date or time format are written as ISO 8601 dates and times
+(e.g., "2019-05-13" or "2019-05-13 14:30:00") instead of as numbers.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   datetime import datetime, timedelta
+from   decimal import Decimal, InvalidOperation
+import posixpath
+import re
+from   xml.etree.ElementTree import iterparse
+import zipfile
+
+from splitit.debug import log
+from splitit.exceptions import *
+
+
+# Constants.
+# .............................................................................
+
+_NS_MAIN = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_NS_REL  = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_NS_PKG  = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+_WORKBOOK      = 'xl/workbook.xml'
+_WORKBOOK_RELS = 'xl/_rels/workbook.xml.rels'
+_SHARED_STRS   = 'xl/sharedStrings.xml'
+_STYLES        = 'xl/styles.xml'
+_DEFAULT_SHEET = 'xl/worksheets/sheet1.xml'
+
+_CELL_REF = re.compile(r'([A-Z]+)')
+
+_BUILTIN_FORMATS = {
+    14: 'date', 15: 'date', 16: 'date', 17: 'date', 22: 'datetime',
+    18: 'time', 19: 'time', 20: 'time', 21: 'time', 45: 'time', 46: 'time', 47: 'time',
+}
+'''Kinds of the built-in Excel number formats that are dates or times.'''
+
+_FORMAT_LITERALS = re.compile(r'"[^"]*"|\\.|\[[^\]]*\]|_.|\*.')
+'''Parts of a number format code that are not date or time fields.'''
+
+_DATE_BASE = datetime(1899, 12, 30)
+_DATE_BASE_1904 = datetime(1904, 1, 1)
+
+
+# Exported functions.
+# .............................................................................
+
+def xlsx_rows(infile):
+    '''Yields the rows of the first worksheet in the .xlsx file 'infile'.
+    Each row is returned as a list of strings, in the same way that
+    csv.reader() does it: missing cells are returned as empty strings.'''
+    try:
+        with zipfile.ZipFile(infile) as archive:
+            strings = _shared_strings(archive)
+            styles = _date_styles(archive)
+            base = _date_base(archive)
+            sheet = _first_sheet(archive)
+            if __debug__: log('reading {} from {}', sheet, infile)
+            with archive.open(sheet) as xml:
+                yield from _sheet_rows(xml, strings, styles, base)
+    except (zipfile.BadZipFile, KeyError) as ex:
+        raise CorruptedContent('Unable to read Excel file {}: {}'.format(infile, ex))
+
+
+def xlsx_data_size(infile):
+    '''Returns the uncompressed size, in bytes, of the first worksheet and
+    the shared-strings table of the .xlsx file 'infile'.'''
+    try:
+        with zipfile.ZipFile(infile) as archive:
+            names = [_first_sheet(archive)]
+            if _SHARED_STRS in archive.namelist():
+                names.append(_SHARED_STRS)
+            return sum(archive.getinfo(name).file_size for name in names)
+    except (zipfile.BadZipFile, KeyError) as ex:
+        raise CorruptedContent('Unable to read Excel file {}: {}'.format(infile, ex))
+
+
+# Internal functions.
+# .............................................................................
+
+def _shared_strings(archive):
+    if _SHARED_STRS not in archive.namelist():
+        return []
+    strings = []
+    with archive.open(_SHARED_STRS) as xml:
+        for event, elem in iterparse(xml):
+            if elem.tag == _NS_MAIN + 'si':
+                strings.append(_string_item_text(elem))
+                elem.clear()
+    if __debug__: log('read {} shared strings', len(strings))
+    return strings
+
+
+def _string_item_text(elem):
+    # A string item is either a single <t> or a series of rich-text runs
+    # <r><t>...</t></r>.  Phonetic hints (<rPh>) also contain <t> elements,
+    # so we can't simply take all the <t> descendants.
+    text = elem.find(_NS_MAIN + 't')
+    if text is not None:
+        return text.text or ''
+    return ''.join(run.findtext(_NS_MAIN + 't', '')
+                   for run in elem.iterfind(_NS_MAIN + 'r'))
+
+
+def _date_styles(archive):
+    '''Returns a dictionary mapping the indexes of the cell styles that have
+    date or time number formats to "date", "time" or "datetime".'''
+    if _STYLES not in archive.namelist():
+        return {}
+    custom = {}
+    styles = {}
+    index = 0
+    in_cell_xfs = False
+    with archive.open(_STYLES) as xml:
+        for event, elem in iterparse(xml, events = ('start', 'end')):
+            if elem.tag == _NS_MAIN + 'cellXfs':
+                in_cell_xfs = (event == 'start')
+            elif event != 'end':
+                continue
+            elif elem.tag == _NS_MAIN + 'numFmt':
+                kind = _format_kind(elem.get('formatCode', ''))
+                if kind:
+                    custom[int(elem.get('numFmtId'))] = kind
+            elif elem.tag == _NS_MAIN + 'xf' and in_cell_xfs:
+                format_id = int(elem.get('numFmtId', 0))
+                kind = custom.get(format_id) or _BUILTIN_FORMATS.get(format_id)
+                if kind:
+                    styles[index] = kind
+                index += 1
+    return styles
+
+
+def _format_kind(code):
+    '''Returns "date", "time", "datetime" or None for a number format code.'''
+    # Only the first section of a format applies to positive numbers.
+    fields = _FORMAT_LITERALS.sub('', code.split(';')[0]).lower()
+    has_date = 'y' in fields or 'd' in fields
+    has_time = 'h' in fields or 's' in fields
+    if has_date and has_time:
+        return 'datetime'
+    if has_date:
+        return 'date'
+    if has_time:
+        return 'time'
+    # "m" alone could be minutes, but in practice it means months.
+    return 'date' if 'm' in fields else None
+
+
+def _date_base(archive):
+    '''Returns the date that day 0 stands for in the workbook.'''
+    with archive.open(_WORKBOOK) as xml:
+        for _, elem in iterparse(xml):
+            if elem.tag == _NS_MAIN + 'workbookPr':
+                if elem.get('date1904', '').lower() in ['1', 'true']:
+                    return _DATE_BASE_1904
+                break
+    return _DATE_BASE
+
+
+def _first_sheet(archive):
+    '''Returns the name of the archive member holding the first worksheet.'''
+    names = archive.namelist()
+    if _WORKBOOK_RELS not in names:
+        return _DEFAULT_SHEET
+    with archive.open(_WORKBOOK) as xml:
+        sheet = next((elem for _, elem in iterparse(xml)
+                      if elem.tag == _NS_MAIN + 'sheet'), None)
+    if sheet is None:
+        return _DEFAULT_SHEET
+    rel_id = sheet.get(_NS_REL + 'id')
+    with archive.open(_WORKBOOK_RELS) as xml:
+        for _, elem in iterparse(xml):
+            if elem.tag == _NS_PKG + 'Relationship' and elem.get('Id') == rel_id:
+                target = elem.get('Target')
+                if target.startswith('/'):
+                    return target.lstrip('/')
+                return posixpath.normpath(posixpath.join('xl', target))
+    return _DEFAULT_SHEET
+
+
+def _sheet_rows(xml, strings, styles = {}, base = _DATE_BASE):
+    width = 0
+    sheet_data = None
+    for event, elem in iterparse(xml, events = ('start', 'end')):
+        if event == 'start':
+            if elem.tag == _NS_MAIN + 'sheetData':
+                sheet_data = elem
+            continue
+        if elem.tag == _NS_MAIN + 'dimension':
+            width = _dimension_width(elem.get('ref', ''))
+        elif elem.tag == _NS_MAIN + 'row':
+            yield _row_values(elem, strings, width, styles, base)
+            # Drop the row from the tree built by iterparse; otherwise the
+            # whole sheet would end up in memory.
+            if sheet_data is not None:
+                sheet_data.clear()
+
+
+def _row_values(row, strings, width, styles, base):
+    values = []
+    for cell in row.iterfind(_NS_MAIN + 'c'):
+        ref = cell.get('r')
+        if ref:
+            column = _column_index(ref)
+            if column > len(values):
+                values.extend([''] * (column - len(values)))
+        values.append(_cell_value(cell, strings, styles, base))
+    if len(values) < width:
+        values.extend([''] * (width - len(values)))
+    return values
+
+
+def _cell_value(cell, strings, styles, base):
+    kind = cell.get('t', 'n')
+    if kind == 'inlineStr':
+        inline = cell.find(_NS_MAIN + 'is')
+        return '' if inline is None else _string_item_text(inline)
+    value = cell.findtext(_NS_MAIN + 'v')
+    if value is None:
+        return ''
+    if kind == 's':
+        return strings[int(value)]
+    if kind == 'n':
+        style = styles.get(int(cell.get('s', 0)))
+        if style:
+            return _date_text(value, style, base)
+        return _number_text(value)
+    if kind == 'b':
+        return 'TRUE' if value == '1' else 'FALSE'
+    return value
+
+
+def _number_text(value):
+    # Barcodes and record id's are stored as numbers when the sheet has been
+    # saved by Excel, sometimes in exponent notation (e.g., 3.5047011136967E+13).
+    # Write integral values the way they appear in the CSV export.
+    try:
+        number = Decimal(value)
+    except InvalidOperation:
+        return value
+    if number == number.to_integral_value():
+        return str(int(number))
+    return value
+
+
+def _date_text(value, kind, base):
+    try:
+        moment = base + timedelta(days = float(value))
+    except (ValueError, OverflowError):
+        return value
+    # Excel stores times as fractions of a day; round off the float error.
+    moment = (moment + timedelta(microseconds = 500000)).replace(microsecond = 0)
+    if kind == 'date':
+        return moment.date().isoformat()
+    if kind == 'time':
+        return moment.time().isoformat()
+    return moment.isoformat(' ')
+
+
+def _column_index(ref):
+    '''Returns the 0-based column index of a cell reference like "AB12".'''
+    letters = _CELL_REF.match(ref).group(1)
+    index = 0
+    for letter in letters:
+        index = index * 26 + (ord(letter) - ord('A') + 1)
+    return index - 1
+
+
+def _dimension_width(ref):
+    '''Returns the number of columns in a dimension reference like "A1:F721".'''
+    last = ref.split(':')[-1]
+    if not _CELL_REF.match(last):
+        return 0
+    return _column_index(last) + 1